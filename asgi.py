@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+
+# Async serving mode. Run with an ASGI server, e.g.
+#   uvicorn asgi:application --workers 1
+# (needs uvicorn, asgiref, httpx, aiosqlite, or asyncpg for PostgreSQL)
+#
+# The JSON read API is served natively here, on an async engine:
+# while one request waits on the database, the event loop serves
+# others, so one worker keeps many requests in flight.
+# Every other route (HTML pages, forms, login) is passed to the
+# Flask app in "project.py", run on a pool of ASGI_THREADS threads.
+# The outbound OAuth calls of login and logout are made here, on an
+# async HTTP client, so a slow identity provider holds no thread.
+
+# Imports from The Python Standard Library
+import asyncio
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone
+from urllib.parse import parse_qs, urlencode
+
+# Imports from SQLAlchemy toolkit
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+# Imports from Werkzeug, asgiref and httpx
+import httpx
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from werkzeug.http import http_date, parse_accept_header, parse_cookie
+from werkzeug.http import parse_date, parse_etags, quote_etag
+
+# Imports from "compression.py"
+from compression import chooseEncoding, compress
+
+# Imports from "database_setup.py"
+from database_setup import tuneSQLite
+
+# Imports from "helper_functions.py"
+from helper_functions import getCategoryAll, getCategoryOne, getCategoryPage
+from helper_functions import getItemAll, getItemByCategory, getItemOne
+from helper_functions import getItemPage, readCatalogVersion
+from helper_functions import CATEGORY_FIELDS, ITEM_FIELDS
+from helper_functions import dumpsJSON, serializeRows
+from helper_functions import catalogETag, isNotModified, parsePageArgs
+
+# Import settings from "config.py"
+import config
+
+# Import the Flask app from "project.py"
+import project
+
+
+def asyncUrl(url):
+    """Returns database URL with the driver swapped for an async one"""
+
+    if url.startswith("sqlite:"):
+        return "sqlite+aiosqlite:" + url[len("sqlite:"):]
+    if url.startswith("postgresql:"):
+        return "postgresql+asyncpg:" + url[len("postgresql:"):]
+    return url
+
+
+# Async engine for the read API, on the read replica if configured
+url = config.DATABASE_REPLICA_URL or config.DATABASE_URL
+async_engine = create_async_engine(asyncUrl(url),
+                                   poolclass=AsyncAdaptedQueuePool,
+                                   pool_size=config.READ_POOL_SIZE,
+                                   max_overflow=config.POOL_MAX_OVERFLOW,
+                                   pool_recycle=config.POOL_RECYCLE,
+                                   pool_timeout=config.POOL_TIMEOUT)
+if url.startswith("sqlite"):
+    tuneSQLite(async_engine.sync_engine, readonly=True)
+AsyncDBSession = sessionmaker(async_engine, class_=AsyncSession,
+                              expire_on_commit=False)
+
+# Threads that run the Flask app. asgiref's own default runs every
+# WSGI request on one shared thread, one request at a time
+wsgi_executor = ThreadPoolExecutor(max_workers=config.ASGI_THREADS,
+                                   thread_name_prefix="wsgi")
+
+
+class PooledWsgiToAsgiInstance(WsgiToAsgiInstance):
+    """Runs one request of the Flask app on wsgi_executor.
+    Entries of scope["catalog.environ"] are added to its WSGI environ"""
+
+    run_wsgi_app = sync_to_async(WsgiToAsgiInstance.run_wsgi_app.__wrapped__,
+                                 thread_sensitive=False,
+                                 executor=wsgi_executor)
+
+    def build_environ(self, scope, body):
+        environ = WsgiToAsgiInstance.build_environ(self, scope, body)
+        environ.update(scope.get("catalog.environ", {}))
+        return environ
+
+
+class PooledWsgiToAsgi(WsgiToAsgi):
+    """WsgiToAsgi running requests on wsgi_executor"""
+
+    async def __call__(self, scope, receive, send):
+        await PooledWsgiToAsgiInstance(self.wsgi_application)(
+            scope, receive, send)
+
+
+# Everything not served below goes to the Flask app
+flask_app = project.create_app()
+flask_application = PooledWsgiToAsgi(flask_app)
+
+# Async HTTP client for the OAuth calls, opened on first login
+oauth_client = None
+
+
+# Payload builders. They take a regular (sync) session and reuse the
+# helper functions; AsyncSession.run_sync runs them on the async
+# connection without blocking the event loop.
+
+def getPageArgs(args):
+    """Returns (limit, after_id, all) from parsed query string,
+    by the rules of parsePageArgs"""
+
+    def first(name):
+        return args.get(name, [None])[0]
+
+    return parsePageArgs(first("limit"), first("after_id"), first("all"))
+
+
+def nextPageUrl(base_url, rows, has_more, limit):
+    """Returns URL of the page after rows, or None on the last page"""
+
+    if not has_more:
+        return None
+    return base_url + "?" + urlencode({"limit": limit,
+                                       "after_id": rows[-1].id})
+
+
+def categoriesPayload(session, base_url, args):
+    limit, after_id, fetch_all = getPageArgs(args)
+    if fetch_all:
+        categories = getCategoryAll(session, CATEGORY_FIELDS)
+        return {"Categories": serializeRows(CATEGORY_FIELDS, categories)}
+    categories, has_more = getCategoryPage(session, limit, after_id,
+                                           CATEGORY_FIELDS)
+    return {"Categories": serializeRows(CATEGORY_FIELDS, categories),
+            "next": nextPageUrl(base_url, categories, has_more, limit)}
+
+
+def categoryPayload(session, base_url, args, category_id):
+    category = getCategoryOne(session, category_id)
+    if category is None:
+        return None
+    return {"Category": category.serialize}
+
+
+def itemsPayload(session, base_url, args, category_id=None):
+    limit, after_id, fetch_all = getPageArgs(args)
+    if fetch_all:
+        if category_id is None:
+            items = getItemAll(session, ITEM_FIELDS)
+        else:
+            items = getItemByCategory(session, category_id, ITEM_FIELDS)
+        return {"Items": serializeRows(ITEM_FIELDS, items)}
+    items, has_more = getItemPage(session, limit, after_id, category_id,
+                                  fields=ITEM_FIELDS)
+    return {"Items": serializeRows(ITEM_FIELDS, items),
+            "next": nextPageUrl(base_url, items, has_more, limit)}
+
+
+def itemPayload(session, base_url, args, item_id):
+    item = getItemOne(session, item_id)
+    if item is None:
+        return None
+    return {"Item": item.serialize}
+
+
+# Same URLs as the JSON routes of "project.py"
+ROUTES = [
+    (re.compile(r"^/category/JSON$"), categoriesPayload),
+    (re.compile(r"^/category/(?P<category_id>\d+)/JSON$"), categoryPayload),
+    (re.compile(r"^/item/JSON$"), itemsPayload),
+    (re.compile(r"^/category/(?P<category_id>\d+)/item/JSON$"),
+     itemsPayload),
+    (re.compile(r"^/item/(?P<item_id>\d+)/JSON$"), itemPayload),
+    (re.compile(r"^/category/\d+/item/(?P<item_id>\d+)/JSON$"), itemPayload),
+]
+
+
+def notModified(headers, etag, updated_at):
+    """Returns True if the client's cached copy is still current"""
+
+    return isNotModified(parse_etags(headers.get("if-none-match")),
+                         parse_date(headers.get("if-modified-since")),
+                         etag, updated_at)
+
+
+async def respond(send, status, headers, body=b""):
+    """Sends complete HTTP response"""
+
+    await send({"type": "http.response.start",
+                "status": status,
+                "headers": [(name.encode("latin-1"), value.encode("latin-1"))
+                            for name, value in headers]})
+    await send({"type": "http.response.body", "body": body})
+
+
+def requestHeaders(scope):
+    """Returns dict of lowercase header names to values"""
+
+    return dict((name.decode("latin-1").lower(), value.decode("latin-1"))
+                for name, value in scope["headers"])
+
+
+async def serveJSON(scope, send, builder, ids):
+    """Serves one JSON read route, with the same conditional GET
+    behaviour as the Flask routes: 304 without touching the ORM"""
+
+    headers = requestHeaders(scope)
+
+    # Get catalog version with one plain statement
+    async with async_engine.connect() as connection:
+        version, updated_at = await connection.run_sync(readCatalogVersion)
+    etag = catalogETag(version)
+    cache_headers = [("ETag", quote_etag(etag)),
+                     ("Cache-Control", "no-cache")]
+    if updated_at is not None:
+        cache_headers.append(
+            ("Last-Modified",
+             http_date(updated_at.replace(tzinfo=timezone.utc))))
+
+    if notModified(headers, etag, updated_at):
+        await respond(send, 304, cache_headers)
+        return
+
+    base_url = "%s://%s%s" % (scope.get("scheme", "http"),
+                              headers.get("host", "localhost"),
+                              scope["path"])
+    args = parse_qs(scope["query_string"].decode("latin-1"))
+    async with AsyncDBSession() as session:
+        payload = await session.run_sync(builder, base_url, args, **ids)
+
+    if payload is None:
+        # Same response as the Flask routes give
+        await respond(send, 404,
+                      cache_headers + [("Content-Type", "application/json")],
+                      dumpsJSON("Not found"))
+        return
+    body = dumpsJSON(payload)
+    body_headers = [("Content-Type", "application/json"),
+                    ("Vary", "Accept-Encoding")]
+    encoding = None
+    if len(body) >= config.COMPRESS_MIN_SIZE:
+        encoding = chooseEncoding(
+            parse_accept_header(headers.get("accept-encoding")))
+    if encoding is not None:
+        body = compress(body, encoding)
+        body_headers.append(("Content-Encoding", encoding))
+        # Same weakened ETag as compressed Flask responses
+        cache_headers[0] = ("ETag", quote_etag(etag, weak=True))
+    body_headers.append(("Content-Length", str(len(body))))
+    await respond(send,
+                  200,
+                  cache_headers + body_headers,
+                  b"" if scope["method"] == "HEAD" else body)
+
+
+def getOAuthClient():
+    """Returns the async HTTP client for the identity provider,
+    with the same timeouts and keep-alive pool as "google_auth.py" """
+
+    global oauth_client
+    if oauth_client is None:
+        oauth_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(config.OAUTH_READ_TIMEOUT,
+                                  connect=config.OAUTH_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_keepalive_connections=config.OAUTH_POOL_SIZE))
+    return oauth_client
+
+
+async def loadLoginSession(headers):
+    """Returns data of the login session named by the request's
+    cookie, or an empty dict"""
+
+    interface = flask_app.session_interface
+    sid = parse_cookie(headers.get("cookie", "")).get(
+        interface.get_cookie_name(flask_app))
+    if not sid:
+        return {}
+    # The store may read a file; keep that off the event loop
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(wsgi_executor, interface.store.get, sid)
+    return data or {}
+
+
+async def connect(headers, query_string, body):
+    """Makes the outbound call of POST /gconnect: exchanges the
+    authorization code, if the state token matches the session.
+    Returns environ entries passing the result to the Flask view"""
+
+    state = parse_qs(query_string).get("state", [None])[0]
+    login_session = await loadLoginSession(headers)
+    if state is None or state != login_session.get("state"):
+        # Nothing to call; the Flask view rejects the request
+        return {}
+
+    # Load OAuth libraries on first login, not at startup
+    from google_auth import AuthError, readTokens, tokenRequest
+    from google_auth import verifyIdToken
+
+    url, data = tokenRequest(body.decode("utf-8"))
+    try:
+        try:
+            response = await getOAuthClient().post(url, data=data)
+        except httpx.HTTPError as e:
+            raise AuthError("Failed to reach identity provider: %s" % e)
+        access_token, id_token = readTokens(response)
+        # Checked against cached certificates, which are refetched
+        # with a blocking call now and then: run it on a thread
+        loop = asyncio.get_running_loop()
+        claims = await loop.run_in_executor(wsgi_executor,
+                                            verifyIdToken, id_token)
+        result = (access_token, claims)
+    except AuthError as e:
+        result = e
+    return {"catalog.exchanged_code": result}
+
+
+async def disconnect(headers):
+    """Makes the outbound call of /gdisconnect: revokes the session's
+    access token. Returns environ entries passing the result, with
+    the token it is for, to the Flask view"""
+
+    access_token = (await loadLoginSession(headers)).get("access_token")
+    if access_token is None:
+        return {}
+
+    # Load OAuth libraries on first use, not at startup
+    from google_auth import getClientConfig
+
+    try:
+        response = await getOAuthClient().post(
+            getClientConfig()["revoke_uri"], params={"token": access_token})
+        revoked = response.status_code == 200
+    except httpx.HTTPError:
+        revoked = False
+    return {"catalog.revoked_token": (access_token, revoked)}
+
+
+async def readBody(receive):
+    """Returns the complete request body"""
+
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    return b"".join(chunks)
+
+
+def replayBody(body, receive):
+    """Returns receive callable that first hands out body again"""
+
+    pending = [body]
+
+    async def receiveAgain():
+        if pending:
+            return {"type": "http.request", "body": pending.pop(),
+                    "more_body": False}
+        return await receive()
+
+    return receiveAgain
+
+
+async def lifespan(receive, send):
+    """Releases pooled connections and threads when the server stops"""
+
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await async_engine.dispose()
+            if oauth_client is not None:
+                await oauth_client.aclose()
+            wsgi_executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    """ASGI entry point"""
+
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+
+    if scope["type"] == "http" and scope["method"] in ("GET", "HEAD"):
+        for pattern, builder in ROUTES:
+            match = pattern.match(scope["path"])
+            if match:
+                ids = dict((name, int(value))
+                           for name, value in match.groupdict().items())
+                await serveJSON(scope, send, builder, ids)
+                return
+
+    # Make the OAuth call of login or logout here, then let the Flask
+    # view finish the request with its result
+    if scope["type"] == "http" and scope["path"] in ("/gconnect",
+                                                     "/gdisconnect"):
+        headers = requestHeaders(scope)
+        body = await readBody(receive)
+        environ = {}
+        if scope["path"] == "/gconnect" and scope["method"] == "POST":
+            environ = await connect(headers,
+                                    scope["query_string"].decode("latin-1"),
+                                    body)
+        elif scope["path"] == "/gdisconnect" and scope["method"] == "GET":
+            environ = await disconnect(headers)
+        scope = dict(scope, **{"catalog.environ": environ})
+        receive = replayBody(body, receive)
+
+    await flask_application(scope, receive, send)
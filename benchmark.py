@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+
+# Imports from The Python Standard Library
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Benchmarks run against a fresh database seeded at each scale.
+# Every scale runs in its own process, because the app binds to
+# the database named in config when "project.py" is imported.
+#
+# Run:
+#   python benchmark.py --items 1000 100000 --output results.json
+# and compare results.json files across commits.
+
+# Routes that need a logged in user are marked with True
+ROUTES = [
+    ("index", "GET", "/", False),
+    ("index_page", "GET", "/?after_id={item_mid}", False),
+    ("read_item_by_category", "GET", "/category/{category}/item/", False),
+    ("read_item_description", "GET",
+     "/category/{category}/item/{item}/description/", False),
+    ("search", "GET", "/search/?q=red+lamp", False),
+    ("show_login", "GET", "/login", False),
+    ("create_category_form", "GET", "/category/create/", True),
+    ("update_category_form", "GET", "/category/{category}/update/", True),
+    ("delete_category_form", "GET", "/category/{category}/delete/", True),
+    ("create_item_form", "GET", "/category/{category}/item/create/", True),
+    ("update_item_form", "GET",
+     "/category/{category}/item/{item}/update/", True),
+    ("delete_item_form", "GET",
+     "/category/{category}/item/{item}/delete/", True),
+    ("create_category", "POST", "/category/create/", True),
+    ("create_item", "POST", "/category/{category}/item/create/", True),
+    ("update_item", "POST", "/category/{category}/item/{item}/update/", True),
+    ("update_category", "POST", "/category/{category}/update/", True),
+    # Every call deletes a category or item created just before it
+    ("delete_item", "POST",
+     "/category/{category}/item/{new_item}/delete/", True),
+    ("delete_category", "POST", "/category/{new_category}/delete/", True),
+    ("categories_json", "GET", "/category/JSON", False),
+    ("categories_json_all", "GET", "/category/JSON?all=true", False),
+    ("category_json", "GET", "/category/{category}/JSON", False),
+    ("items_JSON", "GET", "/item/JSON", False),
+    ("items_JSON_all", "GET", "/item/JSON?all=true", False),
+    ("items_NDJSON", "GET", "/item/NDJSON", False),
+    ("item_JSON", "GET", "/item/{item}/JSON", False),
+    ("category_items_json", "GET", "/category/{category}/item/JSON", False),
+    ("search_json", "GET", "/search/JSON?q=red+lamp", False),
+    ("cache_json", "GET", "/cache/JSON", False),
+]
+# Routes not benchmarked: gconnect and gdisconnect call out to the
+# identity provider, logout redirects to gdisconnect, and bulk_import
+# needs an uploaded file (time bulk_import.py instead)
+SKIPPED_ROUTES = ["gconnect", "gdisconnect", "logout", "bulk_import"]
+# Status every call must return: pages and JSON, or the redirect
+# that follows a successful form post. Anything else fails the run
+EXPECTED_STATUS = {"GET": 200, "POST": 302}
+
+# Run in a fresh interpreter: prints seconds until "project.py" is
+# imported, and until the app is ready to serve
+STARTUP_SCRIPT = """
+import time
+start = time.perf_counter()
+import project
+imported = time.perf_counter()
+project.create_app()
+ready = time.perf_counter()
+print(imported - start, ready - start)
+"""
+# Number of slowest imported modules listed in the startup report
+STARTUP_TOP_MODULES = 15
+
+
+def percentile(samples, fraction):
+    """Returns the given fraction (0 to 1) percentile of samples"""
+
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def measure(function, repeat, engines, before=None):
+    """Calls function repeat times and returns latency percentiles
+    in milliseconds, SQL statements per call and peak memory in KiB"""
+
+    from helper_functions import countQueries
+
+    timings = []
+    queries = 0
+    for n in range(repeat):
+        if before is not None:
+            before()
+        with countQueries(*engines) as statements:
+            start = time.perf_counter()
+            function()
+            timings.append((time.perf_counter() - start) * 1000)
+        queries = len(statements)
+
+    # Measure memory in a separate call, tracing slows calls down
+    if before is not None:
+        before()
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "p50_ms": round(percentile(timings, 0.50), 3),
+        "p95_ms": round(percentile(timings, 0.95), 3),
+        "p99_ms": round(percentile(timings, 0.99), 3),
+        "mean_ms": round(sum(timings) / len(timings), 3),
+        "queries": queries,
+        "peak_kib": round(peak / 1024.0, 1),
+    }
+
+
+def runScale(args):
+    """Seeds a database at one scale and benchmarks it.
+    Runs inside the child process; returns result dict"""
+
+    # Set up database before any app module reads config
+    if args.database_url:
+        os.environ["CATALOG_DATABASE_URL"] = args.database_url
+    else:
+        directory = tempfile.mkdtemp(prefix="catalog-bench-")
+        os.environ["CATALOG_DATABASE_URL"] = (
+            "sqlite:///" + os.path.join(directory, "bench.db"))
+    os.environ["CATALOG_SESSION_BACKEND"] = "memory"
+
+    from database_setup import engine
+    from dummy_data import addSyntheticData
+    import migrate
+
+    start = time.perf_counter()
+    migrate.upgrade(engine)
+    addSyntheticData(engine, args.users, args.categories, args.items)
+    seed_seconds = time.perf_counter() - start
+
+    import helper_functions as helpers
+    import project
+
+    # Routes and helpers run on the app's engines; count queries there
+    engines = (project.engine, project.read_engine)
+    app = project.create_app()
+    client = app.test_client()
+    values = {"category": 1, "item": 1, "item_mid": args.items // 2}
+    login_session = {"username": "User1", "email": "user1@example.com",
+                     "picture": "", "user_id": 1}
+
+    def clearCaches():
+        # Measure the full path, not cache hits, unless --warm
+        if not args.warm:
+            helpers.page_cache.invalidate()
+            helpers.category_cache.invalidate()
+            helpers.user_cache.invalidate()
+
+    def login():
+        with client.session_transaction() as login_session:
+            login_session["username"] = "User1"
+            login_session["email"] = "user1@example.com"
+            login_session["picture"] = ""
+            login_session["user_id"] = 1
+
+    def logout():
+        with client.session_transaction() as login_session:
+            login_session.clear()
+
+    def beforeCall():
+        clearCaches()
+        # Fresh rows for the delete routes to remove
+        values["new_category"] = helpers.CUCategory(
+            project.session, login_session, "bench", "Create")
+        values["new_item"] = helpers.CUItem(
+            project.session, login_session, "bench", "bench", 1, "Create")
+        project.session.remove()
+
+    routes = {}
+    failures = []
+    for name, method, path, needs_login in ROUTES:
+        data = {"name": "bench", "description": "bench"}
+        if needs_login:
+            login()
+        else:
+            logout()
+
+        status = []
+
+        def call():
+            response = client.open(path.format(**values), method=method,
+                                   data=data if method == "POST" else None)
+            # Drain streamed bodies so their cost is counted
+            response.get_data()
+            status.append(response.status_code)
+
+        before = beforeCall if "{new_" in path else clearCaches
+        routes[name] = measure(call, args.repeat, engines, before)
+        routes[name]["method"] = method
+        routes[name]["path"] = path
+        routes[name]["status"] = status[-1]
+
+        # A broken route must not pass as a fast one
+        unexpected = sorted(set(status) - {EXPECTED_STATUS[method]})
+        if unexpected:
+            failures.append("%s returned %s, expected %d" % (
+                name, ", ".join(map(str, unexpected)),
+                EXPECTED_STATUS[method]))
+        if routes[name]["queries"] > project.MAX_QUERIES_PER_REQUEST:
+            failures.append("%s ran %d queries (limit %d)" % (
+                name, routes[name]["queries"],
+                project.MAX_QUERIES_PER_REQUEST))
+
+    session = project.session
+    helper_calls = [
+        ("getCategoryAll", lambda: helpers.getCategoryAll(session)),
+        ("getCategoryList", lambda: helpers.getCategoryList(session)),
+        ("getCategoryOne", lambda: helpers.getCategoryOne(session, 1)),
+        ("getCategoryPage",
+         lambda: helpers.getCategoryPage(session, args.page)),
+        ("getItemAll", lambda: helpers.getItemAll(session)),
+        ("getItemOne", lambda: helpers.getItemOne(session, 1)),
+        ("getItemByCategory",
+         lambda: helpers.getItemByCategory(session, 1)),
+        ("getItemPage", lambda: helpers.getItemPage(session, args.page)),
+        ("iterItemAll",
+         lambda: sum(1 for i in helpers.iterItemAll(session, 1000))),
+        # All items as JSON: through ORM objects and the standard
+        # library, as routes used to, and through row tuples
+        ("serializeItemObjects",
+         lambda: json.dumps(
+             [i.serialize for i in helpers.getItemAll(session)])),
+        ("serializeItemRows",
+         lambda: helpers.dumpsJSON(helpers.serializeRows(
+             helpers.ITEM_FIELDS,
+             helpers.getItemAll(session, helpers.ITEM_FIELDS)))),
+        ("searchItems",
+         lambda: helpers.searchItems(session, "red lamp", args.page)),
+        ("getUserId",
+         lambda: helpers.getUserId("user1@example.com", session)),
+        ("getOrCreateUser",
+         lambda: helpers.getOrCreateUser(login_session, session)),
+        ("getCatalogVersion",
+         lambda: helpers.getCatalogVersion(project.read_engine)),
+        ("CUCategory",
+         lambda: helpers.CUCategory(session, login_session,
+                                    "bench", "Update", 1)),
+        ("CUItem",
+         lambda: helpers.CUItem(session, login_session,
+                                "bench", "bench", 1, "Update", 1)),
+    ]
+
+    def resetSession():
+        clearCaches()
+        session.remove()
+
+    helper_results = {}
+    for name, function in helper_calls:
+        helper_results[name] = measure(function, args.repeat, engines,
+                                       resetSession)
+    for name in ("serializeItemObjects", "serializeItemRows"):
+        helper_results[name]["per_item_us"] = round(
+            helper_results[name]["mean_ms"] * 1000 / max(1, args.items), 3)
+    helper_results["serializeItemRows"]["encoder"] = (
+        "orjson" if helpers.orjson is not None else "json")
+    session.remove()
+
+    return {
+        "database": engine.dialect.name,
+        "scale": {"users": args.users, "categories": args.categories,
+                  "items": args.items},
+        "seed_seconds": round(seed_seconds, 2),
+        "repeat": args.repeat,
+        "warm": args.warm,
+        "failures": failures,
+        "routes": routes,
+        "skipped_routes": SKIPPED_ROUTES,
+        "helpers": helper_results,
+    }
+
+
+def measureStartup(repeat):
+    """Starts repeat fresh interpreters that import the app and returns
+    import and ready times in milliseconds, and the modules that
+    take longest to import by their own code (python -X importtime)"""
+
+    directory = tempfile.mkdtemp(prefix="catalog-start-")
+    environment = dict(
+        os.environ,
+        CATALOG_DATABASE_URL="sqlite:///" + os.path.join(directory,
+                                                         "start.db"),
+        CATALOG_SESSION_SQLITE_PATH=os.path.join(directory, "sessions.db"))
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    imported = []
+    ready = []
+    for n in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, "-c", STARTUP_SCRIPT], env=environment, cwd=here)
+        # Timings are on the last line, after anything the app prints
+        times = output.decode().strip().splitlines()[-1].split()
+        imported.append(float(times[0]) * 1000)
+        ready.append(float(times[1]) * 1000)
+
+    trace = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import project"],
+        env=environment, cwd=here,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE).stderr.decode()
+    modules = []
+    for line in trace.splitlines():
+        # "import time: self [us] | cumulative | imported package"
+        fields = line.split(":", 1)[-1].split("|")
+        if len(fields) == 3 and fields[0].strip().isdigit():
+            modules.append((int(fields[0]), fields[2].strip()))
+    modules.sort(reverse=True)
+
+    return {
+        "repeat": repeat,
+        "import_p50_ms": round(percentile(imported, 0.50), 1),
+        "import_p95_ms": round(percentile(imported, 0.95), 1),
+        "ready_p50_ms": round(percentile(ready, 0.50), 1),
+        "ready_p95_ms": round(percentile(ready, 0.95), 1),
+        "slowest_modules": [
+            {"module": name, "self_ms": round(us / 1000.0, 2)}
+            for us, name in modules[:STARTUP_TOP_MODULES]],
+    }
+
+
+def gitCommit():
+    """Returns the current git commit, or None outside a checkout"""
+
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark routes and helper queries")
+    parser.add_argument("--items", type=int, nargs="+", default=[1000],
+                        help="catalog sizes to benchmark, e.g. "
+                             "1000 100000 1000000")
+    parser.add_argument("--categories", type=int, default=50)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=50,
+                        help="calls per route and helper")
+    parser.add_argument("--page", type=int, default=50,
+                        help="page size passed to paging helpers")
+    parser.add_argument("--warm", action="store_true",
+                        help="keep in-process caches between calls")
+    parser.add_argument("--database-url",
+                        help="empty database to seed and benchmark, e.g. "
+                             "a local PostgreSQL; defaults to a new "
+                             "SQLite file per scale")
+    parser.add_argument("--startup-repeat", type=int, default=10,
+                        help="fresh interpreters started to time app "
+                             "startup, 0 to skip")
+    parser.add_argument("--output", help="write JSON here, not stdout")
+    parser.add_argument("--single", action="store_true",
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        # Child process: one scale, result alone on stdout,
+        # anything app modules print goes to stderr
+        args.items = args.items[0]
+        stdout, sys.stdout = sys.stdout, sys.stderr
+        result = runScale(args)
+        sys.stdout = stdout
+        json.dump(result, sys.stdout)
+        return
+
+    startup = None
+    if args.startup_repeat:
+        print("Benchmarking startup...", file=sys.stderr)
+        startup = measureStartup(args.startup_repeat)
+
+    results = []
+    for items in args.items:
+        command = [sys.executable, os.path.abspath(__file__), "--single",
+                   "--items", str(items),
+                   "--categories", str(args.categories),
+                   "--users", str(args.users),
+                   "--repeat", str(args.repeat),
+                   "--page", str(args.page)]
+        if args.warm:
+            command.append("--warm")
+        if args.database_url:
+            command += ["--database-url", args.database_url]
+        print("Benchmarking %d items..." % items, file=sys.stderr)
+        output = subprocess.check_output(command)
+        results.append(json.loads(output.decode()))
+
+    report = {
+        "commit": gitCommit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "startup": startup,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    # Report is written either way, but the run fails
+    failures = [failure for result in results
+                for failure in result["failures"]]
+    for failure in failures:
+        print("FAILED: %s" % failure, file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+# Imports from The Python Standard Library
+import argparse
+import csv
+import io
+import json
+import sys
+from collections import Counter
+
+# Imports from SQLAlchemy toolkit
+from sqlalchemy.orm import sessionmaker
+
+# Imports from "database_setup.py"
+from database_setup import Category, Item, engine
+
+# Imports from "helper_functions.py"
+from helper_functions import bumpCatalogVersion, category_cache, page_cache
+from helper_functions import changeItemCount, getUserName
+
+# Import settings from "config.py"
+import config
+
+FORMATS = ("csv", "json", "ndjson")
+KINDS = ("category", "item")
+# At most this many row errors are listed in a report
+MAX_REPORTED_ERRORS = 1000
+
+
+def parseRows(stream, format):
+    """Yields (row number, dict) for every record in a text stream.
+    csv and ndjson are read lazily; json must hold one array"""
+
+    if format == "csv":
+        for number, row in enumerate(csv.DictReader(stream), 1):
+            yield number, row
+    elif format == "ndjson":
+        number = 0
+        for line in stream:
+            if not line.strip():
+                continue
+            number += 1
+            try:
+                yield number, json.loads(line)
+            except ValueError as e:
+                yield number, e
+    elif format == "json":
+        for number, row in enumerate(json.load(stream), 1):
+            yield number, row
+    else:
+        raise ValueError("Unknown format %r" % format)
+
+
+def getText(row, field):
+    """Returns value of field in row, None if missing or empty.
+    Raises ValueError if it is not a string: JSON rows may hold
+    numbers, lists or objects"""
+
+    value = row.get(field)
+    if value in (None, ""):
+        return None
+    if not isinstance(value, str):
+        raise ValueError("%s must be a string" % field)
+    return value
+
+
+def getName(row):
+    """Returns the stripped name of row, or raises ValueError"""
+
+    name = (getText(row, "name") or "").strip()
+    if not name:
+        raise ValueError("name is required")
+    if len(name) > 250:
+        raise ValueError("name is longer than 250 characters")
+    return name
+
+
+def getCategoryId(row):
+    """Returns the integer category_id of row, None if missing,
+    or raises ValueError. Numbers with a fraction are rejected,
+    not truncated"""
+
+    value = row.get("category_id")
+    if value in (None, ""):
+        return None
+    # bool is an int, but never a category id
+    if isinstance(value, bool):
+        raise ValueError("category_id must be an integer")
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError("category_id must be an integer")
+        return int(value)
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    raise ValueError("category_id must be an integer")
+
+
+def validateCategory(row, owner, categories, category_ids):
+    """Returns column values for a category row, or raises ValueError"""
+
+    return dict(owner, name=getName(row), item_count=0)
+
+
+def validateItem(row, owner, categories, category_ids):
+    """Returns column values for an item row, or raises ValueError.
+    The category is given by category_id or by category name.
+    categories maps ids to names, category_ids names to ids"""
+
+    name = getName(row)
+    description = getText(row, "description")
+    if description is not None and len(description) > 1000:
+        raise ValueError("description is longer than 1000 characters")
+
+    category_id = getCategoryId(row)
+    category = getText(row, "category")
+    if category_id is not None:
+        if category_id not in categories:
+            raise ValueError("category %d does not exist" % category_id)
+    elif category is not None:
+        category_id = category_ids.get(category)
+        if category_id is None:
+            raise ValueError("category %r does not exist" % category)
+    else:
+        raise ValueError("category_id or category is required")
+
+    return dict(owner,
+                name=name,
+                description=description,
+                category_id=category_id,
+                category_name=categories[category_id])
+
+
+def importRows(session, kind, rows, user_id,
+               batch_size=config.IMPORT_BATCH_SIZE):
+    """Inserts valid rows of kind "category" or "item",
+    batch_size rows per multi-row INSERT and transaction.
+    Invalid rows are skipped and reported; they never abort a batch.
+    Returns report with inserted and failed counts and errors"""
+
+    table, validate = {
+        "category": (Category.__table__, validateCategory),
+        "item": (Item.__table__, validateItem),
+    }[kind]
+
+    # Map category ids to names once, items are checked against it
+    categories = dict(session.query(Category.id, Category.name))
+    category_ids = dict((name, id) for id, name in categories.items())
+    # Owner columns shared by every row
+    owner = {"user_id": user_id, "username": getUserName(session, user_id)}
+    report = {"inserted": 0, "failed": 0, "errors": []}
+    batch = []
+
+    def flush():
+        # Insert batch with one executemany statement
+        session.execute(table.insert(), batch)
+        # Keep item counts in step, one UPDATE per category
+        if kind == "item":
+            counts = Counter(row["category_id"] for row in batch)
+            for category_id, count in counts.items():
+                changeItemCount(session, category_id, count)
+        bumpCatalogVersion(session)
+        session.commit()
+        report["inserted"] += len(batch)
+        del batch[:]
+
+    for number, row in rows:
+        try:
+            if isinstance(row, Exception):
+                raise ValueError(str(row))
+            if not isinstance(row, dict):
+                raise ValueError("record must be an object")
+            batch.append(validate(row, owner, categories, category_ids))
+        except ValueError as e:
+            report["failed"] += 1
+            if len(report["errors"]) < MAX_REPORTED_ERRORS:
+                report["errors"].append({"row": number, "error": str(e)})
+            continue
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    # New rows and counts must show up in cached pages and the aside
+    page_cache.invalidate()
+    category_cache.invalidate()
+    return report
+
+
+def main(argv=None):
+    """Command line entry point"""
+
+    parser = argparse.ArgumentParser(
+        description="Bulk import categories or items")
+    parser.add_argument("kind", choices=KINDS)
+    parser.add_argument("path", help="file to import, - for stdin")
+    parser.add_argument("--format", choices=FORMATS,
+                        help="defaults to the file extension")
+    parser.add_argument("--user-id", type=int, required=True,
+                        help="owner of the imported rows")
+    parser.add_argument("--batch-size", type=int,
+                        default=config.IMPORT_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    format = args.format or args.path.rsplit(".", 1)[-1].lower()
+    if format not in FORMATS:
+        parser.error("can not tell format of %s, use --format" % args.path)
+
+    if args.path == "-":
+        stream = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8")
+    else:
+        stream = open(args.path, "r", encoding="utf-8", newline="")
+
+    session = sessionmaker(bind=engine)()
+    try:
+        with stream:
+            report = importRows(session, args.kind,
+                                parseRows(stream, format),
+                                args.user_id, args.batch_size)
+    finally:
+        session.close()
+
+    print(json.dumps(report, indent=2))
+    return 1 if report["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
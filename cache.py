@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+# Imports from The Python Standard Library
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """In-process cache:
+    1. Entries expire ttl seconds after they are stored,
+    2. At most maxsize entries are kept, least recently used go first,
+    3. Counts hits and misses"""
+
+    def __init__(self, maxsize=128, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns cached value for key, or default if missing or expired"""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                # Mark entry as most recently used
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                # Drop expired entry
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        """Stores value under key, evicting the oldest entry if full"""
+
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """Removes key from cache, or every entry if key is None"""
+
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    @property
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl
+        }
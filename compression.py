@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# Imports from The Python Standard Library
+import gzip
+
+# Imports from Flask
+from flask import request
+
+# Import settings from "config.py"
+import config
+
+# Optional brotli encoder, used when installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Media types of the responses worth compressing
+COMPRESSIBLE_TYPES = ("text/html", "application/json")
+
+
+def chooseEncoding(accept_encodings):
+    """Returns "br", "gzip" or None: the best content coding accepted
+    by the client, given its Accept-Encoding as a werkzeug Accept,
+    that this process can produce"""
+
+    if brotli is not None and accept_encodings.quality("br") > 0:
+        return "br"
+    if accept_encodings.quality("gzip") > 0:
+        return "gzip"
+    return None
+
+
+def compress(body, encoding):
+    """Returns body bytes compressed with encoding ("br" or "gzip")"""
+
+    if encoding == "br":
+        return brotli.compress(body, quality=config.BROTLI_QUALITY)
+    return gzip.compress(body, config.GZIP_LEVEL)
+
+
+def initCompression(app):
+    """Compresses HTML and JSON responses of at least
+    COMPRESS_MIN_SIZE bytes, when the client accepts it.
+    Streamed responses and files are left alone"""
+
+    @app.after_request
+    def compress_response(response):
+        if (response.status_code != 200 or
+                response.mimetype not in COMPRESSIBLE_TYPES or
+                response.direct_passthrough or
+                response.is_streamed or
+                "Content-Encoding" in response.headers):
+            return response
+
+        # Caches must key this response on the client's encodings
+        response.vary.add("Accept-Encoding")
+        encoding = chooseEncoding(request.accept_encodings)
+        if encoding is None:
+            return response
+        body = response.get_data()
+        if len(body) < config.COMPRESS_MIN_SIZE:
+            return response
+
+        response.set_data(compress(body, encoding))
+        response.headers["Content-Encoding"] = encoding
+        # The compressed body is another representation of the same
+        # data: weaken the ETag, so it still matches revalidation
+        # (weak comparison) but is never taken as byte-identical
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            response.set_etag(etag, weak=True)
+        return response
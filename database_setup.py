@@ -3,12 +3,17 @@
 # Imports from The Python Standard Library
 import os
 import sys
+from datetime import datetime
 
 # Imports from SQLAlchemy toolkit
-from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, backref
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+
+# Imports from "config.py"
+import config
 
 # Create instance of declarative base class.
 # Subclasses of the base class correspond to tables
@@ -24,19 +29,25 @@ class User(Base):
     __tablename__ = "user"
     id = Column(Integer, primary_key=True)
     name = Column(String(250), nullable=False)
-    email = Column(String(250), nullable=False)
+    email = Column(String(250), nullable=False, unique=True, index=True)
     picture = Column(String(250))
 
 
 class Category(Base):
     """Modal of Category:
     1. Set table name,
-    2. Initialise columns: id, name"""
+    2. Initialise columns: id, name, updated_at,
+    and item_count and username, which copy data of other tables
+    so that listing categories reads only this table"""
 
     __tablename__ = "category"
     id = Column(Integer, primary_key=True)
     name = Column(String(250), nullable=False)
-    user_id = Column(Integer, ForeignKey("user.id"))
+    updated_at = Column(DateTime, default=datetime.utcnow,
+                        onupdate=datetime.utcnow)
+    item_count = Column(Integer, nullable=False, default=0)
+    username = Column(String(250))
+    user_id = Column(Integer, ForeignKey("user.id"), index=True)
     user = relationship("User",
                         backref=backref("category",
                                         cascade="all, delete-orphan"))
@@ -46,25 +57,37 @@ class Category(Base):
         return {
             "id": self.id,
             "name": self.name,
-            "username": self.user.name
+            "item_count": self.item_count,
+            "username": self.username
         }
 
 
 class Item(Base):
     """Modal of Item:
     1. Set table name,
-    2. Initialise columns: id, name, description, category_id
+    2. Initialise columns: id, name, description, category_id, updated_at,
+    and category_name and username, which copy data of other tables
+    so that listing items reads only this table
     3. Define relationship"""
 
     __tablename__ = "item"
     id = Column(Integer, primary_key=True)
     name = Column(String(250), nullable=False)
     description = Column(String(1000))
-    category_id = Column(Integer, ForeignKey("category.id"))
+    updated_at = Column(DateTime, default=datetime.utcnow,
+                        onupdate=datetime.utcnow)
+    category_name = Column(String(250))
+    username = Column(String(250))
+    # Deleting a category deletes its items in the database,
+    # without loading them (passive_deletes)
+    category_id = Column(Integer,
+                         ForeignKey("category.id", ondelete="CASCADE"),
+                         index=True)
     category = relationship("Category",
                             backref=backref("item",
-                                            cascade="all, delete-orphan"))
-    user_id = Column(Integer, ForeignKey("user.id"))
+                                            cascade="all, delete-orphan",
+                                            passive_deletes=True))
+    user_id = Column(Integer, ForeignKey("user.id"), index=True)
     user = relationship("User",
                         backref=backref("item",
                                         cascade="all, delete-orphan"))
@@ -75,13 +98,96 @@ class Item(Base):
             "id": self.id,
             "name": self.name,
             "description": self.description,
-            "category": self.category.name,
-            "username": self.user.name
+            "category": self.category_name,
+            "username": self.username
         }
 
+
+class CatalogVersion(Base):
+    """Modal of CatalogVersion:
+    1. Set table name,
+    2. Initialise columns: id, version, updated_at
+    Holds a single row (id 1) whose version is bumped
+    by every write to categories or items"""
+
+    __tablename__ = "catalog_version"
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+# Text searched on backends without FTS5 (PostgreSQL).
+# The expression index built by migrate.py and the queries in
+# helper_functions.py must use exactly this expression.
+ITEM_SEARCH_DOCUMENT = ("to_tsvector('simple', coalesce(name, '')"
+                        " || ' ' || coalesce(description, ''))")
+
+
+def tuneSQLite(engine, readonly=False):
+    """Enables foreign keys and applies the SQLite tuning pragmas
+    from config to every connection the engine opens.
+    With readonly, connections also refuse to write"""
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # SQLite ignores ON DELETE CASCADE unless asked not to
+        cursor.execute("PRAGMA foreign_keys=ON")
+        if config.SQLITE_TUNING:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            # Negative cache_size is in KiB rather than pages
+            cursor.execute("PRAGMA cache_size=-%d"
+                           % config.SQLITE_CACHE_SIZE_KIB)
+            cursor.execute("PRAGMA mmap_size=%d" % config.SQLITE_MMAP_SIZE)
+            cursor.execute("PRAGMA busy_timeout=%d"
+                           % config.SQLITE_BUSY_TIMEOUT)
+        if readonly:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+
+
+def makeEngine(url=None, readonly=False):
+    """Returns Engine for the configured database,
+    backed by a connection pool sized from config.
+    With readonly, returns Engine with its own pool of
+    connections that can only read.
+    SQLite and PostgreSQL URLs are supported"""
+
+    url = url or config.DATABASE_URL
+    connect_args = {}
+    if url.startswith("sqlite"):
+        # Pooled connections go to whichever thread serves the next
+        # request; each is used by one thread at a time
+        connect_args["check_same_thread"] = False
+    if readonly and url.startswith("postgresql"):
+        # Make every transaction on these connections read-only
+        connect_args["options"] = "-c default_transaction_read_only=on"
+    engine = create_engine(url,
+                           connect_args=connect_args,
+                           poolclass=QueuePool,
+                           pool_size=(config.READ_POOL_SIZE if readonly
+                                      else config.POOL_SIZE),
+                           max_overflow=config.POOL_MAX_OVERFLOW,
+                           pool_recycle=config.POOL_RECYCLE,
+                           pool_timeout=config.POOL_TIMEOUT)
+    if url.startswith("sqlite"):
+        tuneSQLite(engine, readonly)
+    return engine
+
+
 # Create instance of Engine class,
 # which provides interface to database
-engine = create_engine("sqlite:///item_catelog.db")
+engine = makeEngine()
+
+
+def createTables(engine=engine):
+    """Creates missing tables using classes and corresponding
+    mapper code. Run by "migrate.py", never on import,
+    so starting the app issues no DDL"""
+
+    Base.metadata.create_all(engine)
+
 
-# Create tables using classes and corresponding mapper code
-Base.metadata.create_all(engine)
+if __name__ == "__main__":
+    createTables()
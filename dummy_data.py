@@ -1,115 +1,215 @@
 #!/usr/bin/env python3
 
+# Imports from The Python Standard Library
+import argparse
+import random
+
 # Imports from SQLAlchemy toolkit
-from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 # Imports from "database_setup.py"
-from database_setup import Base, Category, Item, User
-
-# Connect to database,
-# Create session
-engine = create_engine('sqlite:///item_catelog.db')
-# Bind schema constructs(mapper code) to engine
-Base.metadata.bind = engine
-# Create a configured Session class
-DBSession = sessionmaker(bind=engine)
-# Create a session
-session = DBSession()
-
-# Add some users
-user1 = User(name="User1",
-             email="example1@example1.com",
-             picture="http://via.placeholder.com/100x100")
-session.add(user1)
-session.commit()
-
-user2 = User(name="User2",
-             email="example2@example2.com",
-             picture="http://via.placeholder.com/100x100")
-session.add(user2)
-session.commit()
-
-print("Users added!")
-
-# Add some categories
-category1 = Category(name="category1",
-                     user_id=1)
-session.add(category1)
-session.commit()
-
-category2 = Category(name="category2",
-                     user_id=1)
-session.add(category2)
-session.commit()
-
-category3 = Category(name="category3",
-                     user_id=1)
-session.add(category3)
-session.commit()
-
-category4 = Category(name="category4",
-                     user_id=1)
-session.add(category4)
-session.commit()
-
-print("Categories added!")
-
-# Add some items
-item1 = Item(name="item1",
-             description="description1",
-             category_id=1,
-             user_id=1)
-session.add(item1)
-session.commit()
-
-item2 = Item(name="item2",
-             description="description2",
-             category_id=1,
-             user_id=2)
-session.add(item2)
-session.commit()
-
-item3 = Item(name="item3",
-             description="description3",
-             category_id=2,
-             user_id=1)
-session.add(item3)
-session.commit()
-
-item4 = Item(name="item4",
-             description="description4",
-             category_id=2,
-             user_id=2)
-session.add(item4)
-session.commit()
-
-item5 = Item(name="item5",
-             description="description5",
-             category_id=3,
-             user_id=1)
-session.add(item5)
-session.commit()
-
-item6 = Item(name="item6",
-             description="description6",
-             category_id=3,
-             user_id=2)
-session.add(item6)
-session.commit()
-
-item7 = Item(name="item7",
-             description="description7",
-             category_id=4,
-             user_id=1)
-session.add(item7)
-session.commit()
-
-item8 = Item(name="item8",
-             description="description8",
-             category_id=4,
-             user_id=2)
-session.add(item8)
-session.commit()
-
-print("Items added!")
+from database_setup import Base, Category, Item, User, engine
+
+# Imports from "helper_functions.py"
+from helper_functions import bumpCatalogVersion
+
+# Imports from "migrate.py"
+from migrate import repairDenormalizedColumns, upgrade
+
+# Words synthetic names and descriptions are made of,
+# so that searches over generated data find something
+WORDS = ["red", "green", "blue", "small", "large", "fast", "quiet",
+         "wooden", "steel", "glass", "paper", "leather", "vintage",
+         "modern", "classic", "portable", "solid", "light", "heavy",
+         "bright", "camera", "chair", "lamp", "bottle", "jacket", "watch",
+         "bicycle", "guitar", "kettle", "notebook", "racket", "helmet"]
+
+
+def addDummyData(session):
+    """Adds two users, four categories and eight items"""
+
+    # Add some users
+    user1 = User(name="User1",
+                 email="example1@example1.com",
+                 picture="http://via.placeholder.com/100x100")
+    session.add(user1)
+    session.commit()
+
+    user2 = User(name="User2",
+                 email="example2@example2.com",
+                 picture="http://via.placeholder.com/100x100")
+    session.add(user2)
+    session.commit()
+
+    print("Users added!")
+
+    # Add some categories
+    category1 = Category(name="category1",
+                         user_id=1)
+    session.add(category1)
+    session.commit()
+
+    category2 = Category(name="category2",
+                         user_id=1)
+    session.add(category2)
+    session.commit()
+
+    category3 = Category(name="category3",
+                         user_id=1)
+    session.add(category3)
+    session.commit()
+
+    category4 = Category(name="category4",
+                         user_id=1)
+    session.add(category4)
+    session.commit()
+
+    print("Categories added!")
+
+    # Add some items
+    item1 = Item(name="item1",
+                 description="description1",
+                 category_id=1,
+                 user_id=1)
+    session.add(item1)
+    session.commit()
+
+    item2 = Item(name="item2",
+                 description="description2",
+                 category_id=1,
+                 user_id=2)
+    session.add(item2)
+    session.commit()
+
+    item3 = Item(name="item3",
+                 description="description3",
+                 category_id=2,
+                 user_id=1)
+    session.add(item3)
+    session.commit()
+
+    item4 = Item(name="item4",
+                 description="description4",
+                 category_id=2,
+                 user_id=2)
+    session.add(item4)
+    session.commit()
+
+    item5 = Item(name="item5",
+                 description="description5",
+                 category_id=3,
+                 user_id=1)
+    session.add(item5)
+    session.commit()
+
+    item6 = Item(name="item6",
+                 description="description6",
+                 category_id=3,
+                 user_id=2)
+    session.add(item6)
+    session.commit()
+
+    item7 = Item(name="item7",
+                 description="description7",
+                 category_id=4,
+                 user_id=1)
+    session.add(item7)
+    session.commit()
+
+    item8 = Item(name="item8",
+                 description="description8",
+                 category_id=4,
+                 user_id=2)
+    session.add(item8)
+    session.commit()
+
+    print("Items added!")
+
+
+def addSyntheticData(engine, users, categories, items,
+                     batch_size=10000, seed=0):
+    """Adds users, categories and items with generated names,
+    using one executemany INSERT per batch_size rows.
+    Categories and items are spread evenly over users and categories,
+    starting with user 1 and category 1.
+    Used to seed catalogs of any scale, e.g. for benchmarks"""
+
+    rng = random.Random(seed)
+
+    def words(count):
+        return " ".join(rng.choice(WORDS) for x in range(count))
+
+    def insert(table, rows):
+        # Insert rows in batches, one transaction per batch
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                with engine.begin() as connection:
+                    connection.execute(table.insert(), batch)
+                batch = []
+        if batch:
+            with engine.begin() as connection:
+                connection.execute(table.insert(), batch)
+
+    insert(User.__table__,
+           ({"name": "User%d" % n,
+             "email": "user%d@example.com" % n,
+             "picture": "http://via.placeholder.com/100x100"}
+            for n in range(1, users + 1)))
+    insert(Category.__table__,
+           ({"name": "category%d %s" % (n, words(1)),
+             "user_id": (n - 1) % users + 1}
+            for n in range(1, categories + 1)))
+    insert(Item.__table__,
+           ({"name": "item%d %s" % (n, words(2)),
+             "description": words(12),
+             "category_id": (n - 1) % categories + 1,
+             "user_id": (n - 1) % users + 1}
+            for n in range(1, items + 1)))
+
+    # Fill in item counts and names
+    with engine.begin() as connection:
+        repairDenormalizedColumns(connection)
+
+    # Record the change in the catalog version
+    session = sessionmaker(bind=engine)()
+    bumpCatalogVersion(session)
+    session.commit()
+    session.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Populate the database with dummy data")
+    parser.add_argument("--users", type=int,
+                        help="generate this many users (with --items)")
+    parser.add_argument("--categories", type=int, default=10,
+                        help="generate this many categories")
+    parser.add_argument("--items", type=int,
+                        help="generate this many items instead of "
+                             "the fixed dummy data")
+    args = parser.parse_args()
+
+    # Create tables, if this is a new database
+    upgrade(engine)
+    if args.items is None:
+        # Bind schema constructs(mapper code) to engine
+        Base.metadata.bind = engine
+        # Create a configured Session class
+        DBSession = sessionmaker(bind=engine)
+        # Create a session
+        session = DBSession()
+        addDummyData(session)
+        # Fill in item counts and names
+        with engine.begin() as connection:
+            repairDenormalizedColumns(connection)
+        # Record the change in the catalog version, so clients and
+        # running processes drop what they read before seeding
+        bumpCatalogVersion(session)
+        session.commit()
+        session.close()
+    else:
+        addSyntheticData(engine, args.users or 2, args.categories,
+                         args.items)
+        print("Generated %d items!" % args.items)
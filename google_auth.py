@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+# Imports from The Python Standard Library
+import base64
+import json
+import re
+import threading
+import time
+
+# Imports from Requests
+import requests
+from requests.adapters import HTTPAdapter
+
+# Imports from oauth2client
+from oauth2client.crypt import AppIdentityError
+from oauth2client.crypt import verify_signed_jwt_with_certs
+
+# Import settings from "config.py"
+import config
+
+# Issuers Google puts in the "iss" claim of its ID tokens
+ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+
+
+class AuthError(Exception):
+    """Raised when a login can not be completed"""
+
+
+# Parse client secrets once, when the module is first used
+_client_config = None
+
+
+def getClientConfig():
+    """Returns the "web" section of the client secrets file,
+    with endpoint URLs overridden by config where set"""
+
+    global _client_config
+    if _client_config is None:
+        with open(config.CLIENT_SECRETS_FILE, "r") as f:
+            client_config = json.load(f)["web"]
+        client_config["token_uri"] = (config.GOOGLE_TOKEN_URI or
+                                      client_config["token_uri"])
+        client_config["certs_uri"] = (
+            config.GOOGLE_CERTS_URI or
+            client_config["auth_provider_x509_cert_url"])
+        client_config["revoke_uri"] = config.GOOGLE_REVOKE_URI
+        _client_config = client_config
+    return _client_config
+
+
+def _makeHttpSession():
+    """Returns requests session that keeps connections to the
+    provider alive and reuses them across logins"""
+
+    http = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4,
+                          pool_maxsize=config.OAUTH_POOL_SIZE)
+    http.mount("https://", adapter)
+    http.mount("http://", adapter)
+    return http
+
+
+# Shared by all requests; requests sessions are safe for this use
+http = _makeHttpSession()
+TIMEOUT = (config.OAUTH_CONNECT_TIMEOUT, config.OAUTH_READ_TIMEOUT)
+
+
+def resetHttpSession():
+    """Replaces the shared requests session, so a forked worker
+    never writes to connections opened by its parent"""
+
+    global http
+    http = _makeHttpSession()
+
+
+class CertCache(object):
+    """Google's token signing certificates:
+    1. Fetched on first use and kept as long as the provider's
+    Cache-Control max-age allows,
+    2. Refetched early when a token names a key id that is not cached,
+    i.e. after the provider rotated its keys, at most once every
+    OAUTH_CERTS_MIN_REFRESH seconds, so bogus tokens can not make
+    every login wait on the provider"""
+
+    def __init__(self):
+        self.certs = None
+        self.expires = 0
+        self.fetched = 0
+        self._lock = threading.Lock()
+
+    def _current(self, kid):
+        """Returns cached certificates if they can be used for kid"""
+
+        certs = self.certs
+        if certs is None:
+            return None
+        now = time.time()
+        if self.expires <= now:
+            return None
+        if kid is not None and kid not in certs:
+            # Unknown key: refetch, unless that was just done
+            if self.fetched + config.OAUTH_CERTS_MIN_REFRESH > now:
+                return certs
+            return None
+        return certs
+
+    def get(self, kid=None):
+        """Returns dict of key id to PEM certificate, holding the
+        key kid if the provider has it"""
+
+        # Fast path, without waiting on a fetch in another thread
+        certs = self._current(kid)
+        if certs is not None:
+            return certs
+        with self._lock:
+            # Another thread may have fetched while this one waited
+            certs = self._current(kid)
+            if certs is None:
+                response = http.get(getClientConfig()["certs_uri"],
+                                    timeout=TIMEOUT)
+                response.raise_for_status()
+                certs = self.certs = response.json()
+                self.fetched = time.time()
+                self.expires = self.fetched + self._maxAge(response)
+            return certs
+
+    @staticmethod
+    def _maxAge(response):
+        """Returns seconds the certificates may be cached for"""
+
+        match = re.search(r"max-age=(\d+)",
+                          response.headers.get("Cache-Control", ""))
+        if match:
+            return int(match.group(1))
+        return config.OAUTH_CERTS_TTL
+
+
+cert_cache = CertCache()
+
+
+def tokenKeyId(id_token):
+    """Returns the key id ("kid") in the header of a JWT,
+    or None if the header can not be read"""
+
+    try:
+        header = id_token.split(".", 1)[0]
+        # Restore the base64 padding JWTs leave out
+        header += "=" * (-len(header) % 4)
+        return json.loads(base64.urlsafe_b64decode(header)).get("kid")
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+def verifyIdToken(id_token):
+    """Checks signature, expiry, audience and issuer of an ID token
+    against the cached certificates, and that its email is verified.
+    Calls the provider only if the token's key is not cached.
+    Returns the token's claims or raises AuthError"""
+
+    client_id = getClientConfig()["client_id"]
+    try:
+        claims = verify_signed_jwt_with_certs(
+            id_token, cert_cache.get(tokenKeyId(id_token)), client_id)
+    except AppIdentityError as e:
+        raise AuthError("Invalid ID token: %s" % e)
+    except requests.RequestException as e:
+        raise AuthError("Failed to fetch signing certificates: %s" % e)
+
+    if claims.get("iss") not in ISSUERS:
+        raise AuthError("Token's issuer is not Google.")
+    # Users are looked up by email, so it must belong to the user
+    if claims.get("email_verified") not in (True, "true"):
+        raise AuthError("Token's email is not verified.")
+    return claims
+
+
+def tokenRequest(auth_code):
+    """Returns (URL, form data) of the request that upgrades
+    a one-time authorization code into tokens"""
+
+    client_config = getClientConfig()
+    return client_config["token_uri"], {
+        "code": auth_code,
+        "client_id": client_config["client_id"],
+        "client_secret": client_config["client_secret"],
+        "redirect_uri": "postmessage",
+        "grant_type": "authorization_code"}
+
+
+def readTokens(response):
+    """Returns (access token, ID token) from the provider's response
+    to tokenRequest, a requests or httpx response, or raises AuthError"""
+
+    if response.status_code != 200:
+        raise AuthError("Failed to upgrade the authorization code.")
+    tokens = response.json()
+    if "id_token" not in tokens:
+        raise AuthError("Token response has no ID token.")
+    return tokens["access_token"], tokens["id_token"]
+
+
+def exchangeCode(auth_code):
+    """Upgrades one-time authorization code into tokens.
+    This is the only outbound call of a login.
+    Returns (access token, verified ID token claims)"""
+
+    url, data = tokenRequest(auth_code)
+    try:
+        response = http.post(url, data=data, timeout=TIMEOUT)
+    except requests.RequestException as e:
+        raise AuthError("Failed to reach identity provider: %s" % e)
+    access_token, id_token = readTokens(response)
+    return access_token, verifyIdToken(id_token)
+
+
+def revokeToken(access_token):
+    """Revokes access token. Returns True on success"""
+
+    try:
+        response = http.post(getClientConfig()["revoke_uri"],
+                             params={"token": access_token},
+                             timeout=TIMEOUT)
+    except requests.RequestException:
+        return False
+    return response.status_code == 200
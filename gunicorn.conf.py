@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+# Production server settings, read by gunicorn from the working
+# directory:
+#   gunicorn
+# serves "project.py" with one worker process per CPU core.
+#   gunicorn -k uvicorn.workers.UvicornWorker asgi:application
+# serves the async mode of "asgi.py" the same way.
+#
+# The app is imported once in the master process, then workers are
+# forked from it and share its memory, copy-on-write.
+# Signals to the master:
+#   HUP   replace workers gracefully (same code, re-read settings)
+#   USR2, then QUIT to the old master: load new code without downtime
+#   TERM  finish in-flight requests, then stop
+
+# Imports from The Python Standard Library
+import multiprocessing
+import sys
+
+# Import settings from "config.py". Not named "config": gunicorn
+# reads every top-level name here as a setting, and "config" is one
+import config as catalog_config
+
+wsgi_app = "project:create_app()"
+bind = catalog_config.BIND
+workers = catalog_config.WORKERS or multiprocessing.cpu_count()
+threads = catalog_config.WORKER_THREADS
+worker_class = "gthread"
+# Import the app before forking, so workers start warm
+preload_app = True
+# Replace each worker after about this many requests, staggered
+# so workers are not all replaced at once
+max_requests = catalog_config.WORKER_MAX_REQUESTS
+max_requests_jitter = max_requests // 10
+graceful_timeout = catalog_config.GRACEFUL_TIMEOUT
+
+
+def pre_fork(server, worker):
+    """Runs in the master before each fork"""
+
+    # Close connections the master opened while importing the app,
+    # so no worker inherits them
+    import project
+    project.engine.dispose()
+    project.read_engine.dispose()
+
+
+def post_fork(server, worker):
+    """Runs in each new worker"""
+
+    import project
+    project.afterFork()
+    # Async engine of "asgi.py", when serving it
+    if "asgi" in sys.modules:
+        sys.modules["asgi"].async_engine.sync_engine.dispose(close=False)
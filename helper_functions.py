@@ -1,11 +1,55 @@
 #!/usr/bin/env python3
 
 # Imports from The Python Standard Library
+import json
 import random
+import re
 import string
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Imports from SQLAlchemy toolkit
+from sqlalchemy import DateTime, Integer, bindparam, event, text
+from sqlalchemy.exc import IntegrityError
 
 # Imports from "database_setup.py"
-from database_setup import Base, Category, Item, User
+from database_setup import Base, CatalogVersion, Category, Item, User
+from database_setup import ITEM_SEARCH_DOCUMENT
+
+# Imports from "cache.py"
+from cache import TTLCache
+
+# Import settings from "config.py"
+import config
+
+# Optional fast JSON encoder, used when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Cache of the category list rendered in the aside.
+# Holds plain rows, not ORM objects, so entries outlive the session,
+# with the catalog version they were read at: a write in any process
+# bumps the version, so every process rereads the list on next use.
+# Writes in this process also drop it right away.
+category_cache = TTLCache(maxsize=config.CACHE_MAX_ENTRIES,
+                          ttl=config.CATEGORY_CACHE_TTL)
+CategoryRow = namedtuple("CategoryRow",
+                         ["id", "name", "user_id", "item_count"])
+
+# Cache of pages rendered for anonymous visitors.
+# Keys include the catalog version, so a write in any process
+# makes older entries unreachable; writes in this process also
+# drop them right away.
+page_cache = TTLCache(maxsize=config.CACHE_MAX_ENTRIES,
+                      ttl=config.PAGE_CACHE_TTL)
+
+# Cache of user ids by email, consulted on every login.
+# A user's id never changes, so entries only go when users are deleted.
+user_cache = TTLCache(maxsize=config.USER_CACHE_MAX_ENTRIES,
+                      ttl=config.USER_CACHE_TTL)
 
 
 # Create anti forgery state token
@@ -33,24 +77,189 @@ def deleteObject(session, object):
 
     # Delete object
     session.delete(object)
+    # Keep the category's item count in step
+    if isinstance(object, Item):
+        changeItemCount(session, object.category_id, -1)
+    # Record the change in the catalog version
+    bumpCatalogVersion(session)
     # Save changes to database
     session.commit()
+    # Drop cached pages
+    page_cache.invalidate()
+    # Drop cached category list, which shows item counts
+    if isinstance(object, (Category, Item)):
+        category_cache.invalidate()
+    # Drop cached user id
+    if isinstance(object, User):
+        user_cache.invalidate(object.email)
     # Return message
     return "Deleted"
 
 
+# Catalog version helper functions
+def getCatalogVersion(engine):
+    """Returns (version, updated_at) of the catalog.
+    Runs one plain SQL statement without the ORM session,
+    so unchanged data can be answered cheaply"""
+
+    with engine.connect() as connection:
+        return readCatalogVersion(connection)
+
+
+def readCatalogVersion(connection):
+    """Returns (version, updated_at) of the catalog,
+    read on an open connection"""
+
+    statement = text(
+        "SELECT version, updated_at FROM catalog_version WHERE id = 1"
+    ).columns(version=Integer, updated_at=DateTime)
+    row = connection.execute(statement).first()
+    # If no write has happened yet,
+    if row is None:
+        return 0, None
+    return row[0], row[1]
+
+
+def catalogETag(version):
+    """Returns the entity tag of responses built from catalog version"""
+
+    return "catalog-%d" % version
+
+
+def isNotModified(if_none_match, if_modified_since, etag, updated_at):
+    """Returns True if the client's cached copy is still current.
+    if_none_match is the parsed If-None-Match header (a werkzeug
+    ETags), if_modified_since the parsed If-Modified-Since date
+    or None. Serving modes parse the headers, this compares them"""
+
+    # If-None-Match takes precedence over If-Modified-Since.
+    # Compressed responses carry the ETag weakened, so compare weakly
+    if if_none_match:
+        return if_none_match.contains_weak(etag)
+    if if_modified_since is not None and updated_at is not None:
+        since = if_modified_since
+        if since.tzinfo is not None:
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+        # HTTP dates have a resolution of one second
+        return updated_at.replace(microsecond=0) <= since
+    return False
+
+
+def bumpCatalogVersion(session):
+    """Increments the catalog version inside the session's transaction,
+    so it is committed together with the change it records"""
+
+    now = datetime.utcnow()
+    result = session.execute(
+        text("UPDATE catalog_version"
+             " SET version = version + 1, updated_at = :now"
+             " WHERE id = 1").bindparams(bindparam("now", type_=DateTime)),
+        {"now": now})
+    # If the row does not exist yet, create it
+    if result.rowcount == 0:
+        session.add(CatalogVersion(id=1, version=1, updated_at=now))
+
+
+# JSON keys and columns of Category.serialize and Item.serialize.
+# JSON listings select only these columns, as row tuples,
+# so no ORM objects are built for them
+CATEGORY_FIELDS = (("id", Category.id),
+                   ("name", Category.name),
+                   ("item_count", Category.item_count),
+                   ("username", Category.username))
+ITEM_FIELDS = (("id", Item.id),
+               ("name", Item.name),
+               ("description", Item.description),
+               ("category", Item.category_name),
+               ("username", Item.username))
+
+
+def parsePageArgs(limit, after_id, fetch_all):
+    """Returns (limit, after_id, all) from raw query string values,
+    each a string or None. limit defaults to PAGE_SIZE and is clamped
+    to MAX_PAGE_SIZE; values that are not integers are ignored;
+    all is True only for "true" """
+
+    def integer(value, default=None):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return default
+
+    limit = integer(limit, config.PAGE_SIZE)
+    limit = max(1, min(limit, config.MAX_PAGE_SIZE))
+    return limit, integer(after_id), (fetch_all or "").lower() == "true"
+
+
+def queryRows(session, fields):
+    """Returns query of row tuples holding only the columns of fields"""
+
+    return session.query(*[column for key, column in fields])
+
+
+def serializeRows(fields, rows):
+    """Returns list of dicts for row tuples of fields,
+    the same dicts the serialize properties build"""
+
+    keys = [key for key, column in fields]
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def dumpsJSON(value):
+    """Returns value encoded as compact JSON bytes,
+    with orjson if installed, else the standard library"""
+
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+
+def changeItemCount(session, category_id, change):
+    """Adds change to the item count of given category,
+    inside the session's transaction"""
+
+    session.query(Category).filter_by(id=category_id).update(
+        {Category.item_count: Category.item_count + change},
+        synchronize_session=False)
+
+
+@contextmanager
+def countQueries(*engines):
+    """Counts SQL statements executed on engines inside the block.
+    Yields a list whose length is the number of statements run"""
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        for engine in engines:
+            event.remove(engine, "before_cursor_execute",
+                         before_cursor_execute)
+
+
 # User helper functions
 def getUserId(email, session):
     """Returns user id corresponding to the given email"""
 
-    try:
-        # For given email, get user object
-        user = session.query(User).filter_by(email=email).one()
-        # Return user id
-        return user_id
-    except Exception as e:
-        # If user not found,
+    # For given email, get user id with one indexed read
+    row = session.query(User.id).filter_by(email=email).first()
+    # If user not found,
+    if row is None:
         return None
+    # Return user id
+    return row[0]
+
+
+def getUserName(session, user_id):
+    """Returns name of the user with given id"""
+
+    return session.query(User.name).filter_by(id=user_id).scalar()
 
 
 def createUser(login_session, session):
@@ -69,13 +278,45 @@ def createUser(login_session, session):
     return user.id
 
 
+def getOrCreateUser(login_session, session):
+    """Returns id of the user with the email in login_session,
+    creating the user on first login.
+    Repeat logins are answered from user_cache without touching
+    the database, or by one indexed read when not cached"""
+
+    email = login_session["email"]
+    # Get user id from cache
+    user_id = user_cache.get(email)
+    if user_id is not None:
+        return user_id
+
+    # If not cached, look user up by email
+    user_id = getUserId(email, session)
+    if user_id is None:
+        try:
+            # If user not found, create user
+            user_id = createUser(login_session, session)
+        except IntegrityError:
+            # A concurrent login created the user first,
+            # the unique index on email rejected the duplicate
+            session.rollback()
+            user_id = getUserId(email, session)
+
+    user_cache.set(email, user_id)
+    return user_id
+
+
 # Category helper functions
-def getCategoryAll(session):
-    """Returns list of all category objects from database"""
+def getCategoryAll(session, fields=None):
+    """Returns list of all category objects from database,
+    or row tuples of only the columns of fields, if given"""
 
     try:
         # Get all categories from database
-        categories = session.query(Category).all()
+        if fields is None:
+            categories = session.query(Category).all()
+        else:
+            categories = queryRows(session, fields).all()
         # Return categories object
         return categories
     except Exception as e:
@@ -83,6 +324,44 @@ def getCategoryAll(session):
         return None
 
 
+def getCategoryPage(session, limit, after_id=None, fields=None):
+    """Returns up to limit categories with id greater than after_id,
+    ordered by id, and whether more categories follow.
+    With fields, returns row tuples of only those columns"""
+
+    # Keyset pagination: seek past after_id on the primary key
+    if fields is None:
+        query = session.query(Category)
+    else:
+        query = queryRows(session, fields)
+    if after_id is not None:
+        query = query.filter(Category.id > after_id)
+    # Fetch one extra row to know if there is a next page
+    categories = query.order_by(Category.id).limit(limit + 1).all()
+    return categories[:limit], len(categories) > limit
+
+
+def getCategoryList(session):
+    """Returns list of (id, name, user_id, item_count) rows for all
+    categories, served from category_cache while the catalog version
+    they were read at is current"""
+
+    version = readCatalogVersion(session.connection())[0]
+    # Get categories from cache
+    cached = category_cache.get("categories")
+    if cached is not None and cached[0] == version:
+        categories = cached[1]
+    else:
+        # If not cached, or changed since, get them from database
+        categories = tuple(
+            CategoryRow(*row) for row in session.query(
+                Category.id, Category.name, Category.user_id,
+                Category.item_count))
+        category_cache.set("categories", (version, categories))
+    # Return a fresh list, so callers can not alter the cached rows
+    return list(categories)
+
+
 def getCategoryOne(session, category_id):
     """Returns the category object for given id"""
 
@@ -103,27 +382,42 @@ def CUCategory(session, login_session, name, CU, id=None):
     if CU == "Create":
         # Create category
         category = Category(name=name,
-                            user_id=login_session["user_id"])
+                            user_id=login_session["user_id"],
+                            item_count=0,
+                            username=getUserName(session,
+                                                 login_session["user_id"]))
     elif CU == "Update":
         # Update category
         category = getCategoryOne(session, id)
         category.name = name
+        # Rename the category on its items too
+        session.query(Item).filter_by(category_id=id).update(
+            {Item.category_name: name}, synchronize_session=False)
 
     # Add category object to session
     session.add(category)
+    # Record the change in the catalog version
+    bumpCatalogVersion(session)
     # Save object to database
     session.commit()
+    # Drop cached pages and category list
+    page_cache.invalidate()
+    category_cache.invalidate()
     # return category id
     return category.id
 
 
 # Item helper functions
-def getItemAll(session):
-    """Returns all item objects from database"""
+def getItemAll(session, fields=None):
+    """Returns all item objects from database,
+    or row tuples of only the columns of fields, if given"""
 
     try:
         # Get all items from database
-        items = session.query(Item).all()
+        if fields is None:
+            items = session.query(Item).all()
+        else:
+            items = queryRows(session, fields).all()
         # Return items object
         return items
     except Exception as e:
@@ -144,12 +438,17 @@ def getItemOne(session, item_id):
         return None
 
 
-def getItemByCategory(session, category_id):
-    """Returns all item objects for given category id"""
+def getItemByCategory(session, category_id, fields=None):
+    """Returns all item objects for given category id,
+    or row tuples of only the columns of fields, if given"""
 
     try:
         # Get items by category id
-        items = session.query(Item).filter_by(category_id=category_id).all()
+        if fields is None:
+            query = session.query(Item)
+        else:
+            query = queryRows(session, fields)
+        items = query.filter(Item.category_id == category_id).all()
         # Return items object
         return items
     except Exception as e:
@@ -157,6 +456,100 @@ def getItemByCategory(session, category_id):
         return None
 
 
+def getItemPage(session, limit, after_id=None, category_id=None,
+                before_id=None, fields=None):
+    """Returns up to limit items with id greater than after_id,
+    ordered by id, optionally only for given category id,
+    and whether more items follow.
+    If before_id is given instead, returns the items just before it,
+    still ordered by id, and whether more items precede them.
+    With fields, returns row tuples of only those columns"""
+
+    # Keyset pagination: seek past after_id on the primary key
+    if fields is None:
+        query = session.query(Item)
+    else:
+        query = queryRows(session, fields)
+    if category_id is not None:
+        query = query.filter(Item.category_id == category_id)
+    if before_id is not None:
+        # Walk backwards from before_id, then restore id order
+        query = query.filter(Item.id < before_id).order_by(Item.id.desc())
+        items = query.limit(limit + 1).all()
+        return list(reversed(items[:limit])), len(items) > limit
+    if after_id is not None:
+        query = query.filter(Item.id > after_id)
+    # Fetch one extra row to know if there is a next page
+    items = query.order_by(Item.id).limit(limit + 1).all()
+    return items[:limit], len(items) > limit
+
+
+def iterItemAll(session, batch_size, fields=None):
+    """Returns iterator over all items ordered by id,
+    fetched from a server-side cursor batch_size rows at a time.
+    With fields, yields row tuples of only those columns"""
+
+    if fields is None:
+        query = session.query(Item)
+    else:
+        query = queryRows(session, fields)
+    return query.order_by(Item.id).yield_per(batch_size)
+
+
+def searchQuery(terms, dialect="sqlite"):
+    """Returns full-text query for free text typed by a user:
+    an FTS5 MATCH expression, or a tsquery on PostgreSQL.
+    Every word must match; the last word also matches as a prefix"""
+
+    words = re.findall(r"\w+", terms, re.UNICODE)
+    if not words:
+        return None
+    if dialect == "postgresql":
+        return " & ".join(words) + ":*"
+    # Quote words, so FTS5 operators in the input are taken literally
+    phrases = ['"%s"' % word for word in words]
+    phrases[-1] += "*"
+    return " ".join(phrases)
+
+
+def searchItems(session, terms, limit, offset=0):
+    """Returns up to limit items matching terms, best match first,
+    skipping the first offset matches, and whether more items follow"""
+
+    dialect = session.get_bind().dialect.name
+    match = searchQuery(terms, dialect)
+    if match is None:
+        return [], False
+
+    if dialect == "postgresql":
+        # Rank matches with ts_rank using the GIN expression index
+        statement = text(
+            "SELECT id FROM item"
+            " WHERE %s @@ to_tsquery('simple', :match)"
+            " ORDER BY ts_rank(%s, to_tsquery('simple', :match)) DESC, id"
+            " LIMIT :limit OFFSET :offset"
+            % (ITEM_SEARCH_DOCUMENT, ITEM_SEARCH_DOCUMENT))
+    else:
+        # Rank matches with bm25 using the full-text index
+        statement = text(
+            "SELECT rowid FROM item_fts WHERE item_fts MATCH :match"
+            " ORDER BY rank LIMIT :limit OFFSET :offset")
+    rows = session.execute(
+        statement,
+        {"match": match, "limit": limit + 1, "offset": offset}).fetchall()
+    ids = [row[0] for row in rows]
+    has_more = len(ids) > limit
+    ids = ids[:limit]
+    if not ids:
+        return [], False
+
+    # Load the matching items, then restore rank order
+    items = session.query(Item).filter(Item.id.in_(ids)).all()
+    position = dict((id, index) for index, id in enumerate(ids))
+    items.sort(key=lambda item: position[item.id])
+    return items, has_more
+
+
 def CUItem(session, login_session,
            name, description, category_id, CU, id=None):
     """Performs Insert or Update on item table
@@ -164,10 +557,16 @@ def CUItem(session, login_session,
 
     if CU == "Create":
         # Create item
+        category_name = session.query(Category.name).filter_by(
+            id=category_id).scalar()
         item = Item(name=name,
                     description=description,
                     category_id=category_id,
-                    user_id=login_session["user_id"])
+                    category_name=category_name,
+                    user_id=login_session["user_id"],
+                    username=getUserName(session, login_session["user_id"]))
+        # Keep the category's item count in step
+        changeItemCount(session, category_id, 1)
     elif CU == "Update":
         # Update item
         item = getItemOne(session, id)
@@ -176,7 +575,13 @@ def CUItem(session, login_session,
 
     # Add item object to session
     session.add(item)
+    # Record the change in the catalog version
+    bumpCatalogVersion(session)
     # Save object to database
     session.commit()
+    # Drop cached pages, and category list, which shows item counts
+    page_cache.invalidate()
+    if CU == "Create":
+        category_cache.invalidate()
     # Return item id
     return item.id
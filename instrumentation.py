@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+# Imports from The Python Standard Library
+import heapq
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Imports from Flask
+from flask import Response, g, has_app_context, request
+from flask import before_render_template, template_rendered
+
+# Imports from SQLAlchemy toolkit
+from sqlalchemy import event
+
+# Import settings from "config.py"
+import config
+
+# Upper bounds, in seconds, of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """Prometheus-style histogram of observations per route"""
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        # route -> [bucket counts..., +Inf count, sum]
+        self.series = {}
+
+    def observe(self, route, value):
+        series = self.series.get(route)
+        if series is None:
+            series = self.series[route] = [0] * (len(BUCKETS) + 2)
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                series[index] += 1
+        series[-2] += 1
+        series[-1] += value
+
+    def render(self):
+        """Returns lines in Prometheus text exposition format"""
+
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s histogram" % self.name]
+        for route, series in sorted(self.series.items()):
+            for index, bound in enumerate(BUCKETS):
+                lines.append('%s_bucket{route="%s",le="%s"} %d'
+                             % (self.name, route, bound, series[index]))
+            lines.append('%s_bucket{route="%s",le="+Inf"} %d'
+                         % (self.name, route, series[-2]))
+            lines.append('%s_count{route="%s"} %d'
+                         % (self.name, route, series[-2]))
+            lines.append('%s_sum{route="%s"} %f'
+                         % (self.name, route, series[-1]))
+        return lines
+
+
+class Metrics(object):
+    """Request metrics of this process, per route"""
+
+    def __init__(self):
+        self.total = Histogram("catalog_request_duration_seconds",
+                               "Time spent handling requests.")
+        self.sql = Histogram("catalog_request_sql_seconds",
+                             "Time spent in SQL per request.")
+        self.render = Histogram("catalog_request_render_seconds",
+                                "Time spent rendering templates per request.")
+        self.queries = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, route, total, sql, render, queries):
+        with self._lock:
+            self.total.observe(route, total)
+            self.sql.observe(route, sql)
+            self.render.observe(route, render)
+            self.queries[route] += queries
+
+    def render_text(self):
+        with self._lock:
+            lines = (self.total.render() + self.sql.render() +
+                     self.render.render())
+            lines.append("# HELP catalog_request_sql_queries_total "
+                         "SQL statements executed by requests.")
+            lines.append("# TYPE catalog_request_sql_queries_total counter")
+            for route, count in sorted(self.queries.items()):
+                lines.append('catalog_request_sql_queries_total'
+                             '{route="%s"} %d' % (route, count))
+        return "\n".join(lines) + "\n"
+
+
+class SamplingProfiler(object):
+    """Samples the stacks of threads that are handling requests
+    every interval seconds, from one background thread.
+    Keeps collapsed stacks of the keep slowest requests slower than
+    threshold seconds as files in directory, one file per request,
+    in the format flamegraph tools read.
+    The sampling thread starts with the first request of each process,
+    as threads do not survive a fork into worker processes"""
+
+    def __init__(self, interval, threshold, keep, directory):
+        self.interval = interval
+        self.threshold = threshold
+        self.keep = keep
+        self.directory = directory
+        # thread id -> Counter of collapsed stacks
+        self.active = {}
+        # heap of (duration, path) of the slowest dumps kept
+        self.slowest = []
+        self._lock = threading.Lock()
+        # Process the sampling thread runs in
+        self._pid = None
+
+    def start(self, thread_id):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                thread = threading.Thread(target=self._run, name="profiler")
+                thread.daemon = True
+                thread.start()
+            self.active[thread_id] = Counter()
+
+    def stop(self, thread_id, route, duration):
+        """Stops sampling thread_id and dumps its samples if the
+        request is among the slowest seen"""
+
+        with self._lock:
+            samples = self.active.pop(thread_id, None)
+            if not samples or duration < self.threshold:
+                return
+            if len(self.slowest) >= self.keep:
+                if duration <= self.slowest[0][0]:
+                    return
+                evicted = heapq.heappop(self.slowest)[1]
+                if os.path.exists(evicted):
+                    os.remove(evicted)
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            path = os.path.join(self.directory, "%d-%s-%dms.txt" % (
+                time.time() * 1000, route, duration * 1000))
+            heapq.heappush(self.slowest, (duration, path))
+
+        with open(path, "w") as f:
+            for stack, count in samples.most_common():
+                f.write("%s %d\n" % (stack, count))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, samples in self.active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[self._collapse(frame)] += 1
+
+    @staticmethod
+    def _collapse(frame):
+        """Returns stack of frame as "outer;...;inner" string"""
+
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("%s:%s:%d" % (os.path.basename(code.co_filename),
+                                       code.co_name, frame.f_lineno))
+            frame = frame.f_back
+        return ";".join(reversed(stack))
+
+
+def initInstrumentation(app, *engines):
+    """Records, for every request, SQL statement count and time,
+    template render time and total time. Adds them to the response
+    as a Server-Timing header, and exposes per-route histograms
+    at /metrics. Requests slower than PROFILE_SLOW_SECONDS are
+    profiled into PROFILE_DIR"""
+
+    metrics = Metrics()
+    profiler = None
+    if config.PROFILE_DIR:
+        profiler = SamplingProfiler(config.PROFILE_INTERVAL,
+                                    config.PROFILE_SLOW_SECONDS,
+                                    config.PROFILE_KEEP,
+                                    config.PROFILE_DIR)
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        if has_app_context() and "timing_start" in g:
+            g.timing_sql_start = time.perf_counter()
+
+    def after_cursor_execute(conn, cursor, statement, *args):
+        if has_app_context() and "timing_sql_start" in g:
+            g.timing_sql += time.perf_counter() - g.pop("timing_sql_start")
+            g.timing_queries += 1
+
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+    @before_render_template.connect_via(app)
+    def before_render(sender, template, context, **extra):
+        g.timing_render_start = time.perf_counter()
+
+    @template_rendered.connect_via(app)
+    def after_render(sender, template, context, **extra):
+        if "timing_render_start" in g:
+            g.timing_render += (time.perf_counter() -
+                                g.pop("timing_render_start"))
+
+    @app.before_request
+    def start_timing():
+        g.timing_start = time.perf_counter()
+        g.timing_sql = 0.0
+        g.timing_render = 0.0
+        g.timing_queries = 0
+        if profiler is not None:
+            profiler.start(threading.get_ident())
+
+    @app.after_request
+    def add_server_timing(response):
+        if "timing_start" not in g:
+            return response
+        total = time.perf_counter() - g.timing_start
+        route = request.endpoint or "unmatched"
+        metrics.record(route, total, g.timing_sql, g.timing_render,
+                       g.timing_queries)
+        if profiler is not None:
+            profiler.stop(threading.get_ident(), route, total)
+
+        response.headers["Server-Timing"] = (
+            'sql;dur=%.2f;desc="%d queries", tpl;dur=%.2f, total;dur=%.2f'
+            % (g.timing_sql * 1000, g.timing_queries,
+               g.timing_render * 1000, total * 1000))
+        return response
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics_text():
+        """Returns request metrics in Prometheus text format"""
+
+        return Response(metrics.render_text(),
+                        mimetype="text/plain; version=0.0.4")
+
+    return metrics
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+# Imports from The Python Standard Library
+import argparse
+import http.client
+import http.server
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+# Drives concurrent requests at a running server and reports
+# throughput and latency percentiles as JSON. Meanwhile, --logins
+# clients keep logging in against a stub identity provider that takes
+# --login-delay seconds to answer, as a slow provider would; a server
+# that waits on it with a shared thread stalls every other route.
+#
+# Start the threaded Flask server and the ASGI server in turn,
+# against the same database, and compare them:
+#   python loadtest.py --compare --concurrency 100
+# or run against a server that is already up, started with
+# CATALOG_GOOGLE_TOKEN_URI=http://127.0.0.1:8766/token:
+#   python loadtest.py --url http://localhost:8000 --concurrency 100
+
+# Read-only routes, JSON and HTML; the mix most clients send
+PATHS = ["/category/JSON", "/item/JSON", "/category/1/item/JSON",
+         "/item/1/JSON", "/category/1/JSON", "/", "/category/1/item/",
+         "/category/1/item/1/description/"]
+
+# Commands that start each server on a port
+SERVERS = {
+    "threaded": [sys.executable, "-m", "flask", "run", "--with-threads",
+                 "--port", "{port}"],
+    "asgi": [sys.executable, "-m", "uvicorn", "asgi:application",
+             "--port", "{port}", "--log-level", "warning"],
+}
+
+
+def percentile(samples, fraction):
+    """Returns the given fraction (0 to 1) percentile of samples"""
+
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class SlowProvider(http.server.BaseHTTPRequestHandler):
+    """Stub identity provider: refuses every authorization code,
+    after delay seconds"""
+
+    delay = 1.0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.delay)
+        body = b'{"error": "invalid_grant"}'
+        self.send_response(400)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def startProvider(port, delay):
+    """Starts the stub identity provider on port, in the background"""
+
+    SlowProvider.delay = delay
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port),
+                                             SlowProvider)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def login(connection, cookie):
+    """Gets a state token from /login and posts a code to /gconnect,
+    which the stub provider refuses. Returns (session cookie, status)"""
+
+    headers = {"Cookie": cookie} if cookie else {}
+    connection.request("GET", "/login", headers=headers)
+    response = connection.getresponse()
+    page = response.read().decode("utf-8")
+    cookie = (response.getheader("Set-Cookie") or cookie or "").split(";")[0]
+    state = re.search(r"state=(\w+)", page).group(1)
+    connection.request("POST", "/gconnect?state=" + state, body=b"code",
+                       headers={"Cookie": cookie,
+                                "Content-Type":
+                                    "application/octet-stream"})
+    response = connection.getresponse()
+    response.read()
+    return cookie, response.status
+
+
+def run(url, paths, concurrency, requests, logins=0):
+    """Sends requests GETs from concurrency threads, each on its own
+    keep-alive connection, while logins threads keep logging in,
+    and returns the measured results"""
+
+    parts = urlsplit(url)
+    timings = []
+    errors = [0]
+    login_timings = []
+    login_errors = [0]
+    lock = threading.Lock()
+    done = threading.Event()
+    per_worker = max(1, requests // concurrency)
+
+    def worker(number):
+        connection = http.client.HTTPConnection(parts.hostname, parts.port,
+                                                timeout=30)
+        local = []
+        failed = 0
+        for n in range(per_worker):
+            path = paths[(number + n) % len(paths)]
+            start = time.perf_counter()
+            try:
+                connection.request("GET", path)
+                response = connection.getresponse()
+                response.read()
+                if response.status >= 400:
+                    failed += 1
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                connection.close()
+                continue
+            local.append((time.perf_counter() - start) * 1000)
+        connection.close()
+        with lock:
+            timings.extend(local)
+            errors[0] += failed
+
+    def loginWorker(number):
+        connection = http.client.HTTPConnection(parts.hostname, parts.port,
+                                                timeout=30)
+        cookie = None
+        while not done.is_set():
+            start = time.perf_counter()
+            try:
+                cookie, status = login(connection, cookie)
+            except (OSError, http.client.HTTPException, AttributeError):
+                status = None
+                connection.close()
+            with lock:
+                # The stub provider refuses the code: 401 is success
+                if status == 401:
+                    login_timings.append((time.perf_counter() - start) * 1000)
+                else:
+                    login_errors[0] += 1
+        connection.close()
+
+    login_threads = [threading.Thread(target=loginWorker, args=(number,))
+                     for number in range(logins)]
+    for thread in login_threads:
+        thread.start()
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(worker, range(concurrency)))
+        elapsed = time.perf_counter() - start
+    finally:
+        done.set()
+        for thread in login_threads:
+            thread.join()
+
+    result = {
+        "concurrency": concurrency,
+        "requests": per_worker * concurrency,
+        "errors": errors[0],
+        "seconds": round(elapsed, 2),
+        "requests_per_second": round(len(timings) / elapsed, 1),
+    }
+    if timings:
+        result.update({
+            "p50_ms": round(percentile(timings, 0.50), 3),
+            "p95_ms": round(percentile(timings, 0.95), 3),
+            "p99_ms": round(percentile(timings, 0.99), 3),
+        })
+    if logins:
+        result["logins"] = {"concurrency": logins,
+                            "completed": len(login_timings),
+                            "errors": login_errors[0]}
+        if login_timings:
+            result["logins"]["p50_ms"] = round(
+                percentile(login_timings, 0.50), 3)
+    return result
+
+
+def waitForServer(port, process, timeout=30):
+    """Waits until something accepts requests on port"""
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("server exited with %d" % process.returncode)
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port,
+                                                    timeout=1)
+            connection.request("GET", "/category/JSON")
+            connection.getresponse().read()
+            connection.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("server did not start on port %d" % port)
+
+
+def compare(args):
+    """Starts each server in turn and load tests it"""
+
+    results = {}
+    for name, command in sorted(SERVERS.items()):
+        command = [part.format(port=args.port) for part in command]
+        environment = dict(os.environ, FLASK_APP="project:create_app()",
+                           CATALOG_GOOGLE_TOKEN_URI="http://127.0.0.1:%d/token"
+                           % args.provider_port)
+        process = subprocess.Popen(command, env=environment,
+                                   stdout=subprocess.DEVNULL)
+        try:
+            waitForServer(args.port, process)
+            print("Load testing %s server..." % name, file=sys.stderr)
+            results[name] = run("http://127.0.0.1:%d" % args.port,
+                                args.paths, args.concurrency, args.requests,
+                                args.logins)
+        finally:
+            process.terminate()
+            process.wait()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load test the catalog's read routes and login")
+    parser.add_argument("--url", default="http://127.0.0.1:8000",
+                        help="server to load test")
+    parser.add_argument("--paths", nargs="+", default=PATHS)
+    parser.add_argument("--concurrency", type=int, default=50,
+                        help="requests in flight at once")
+    parser.add_argument("--requests", type=int, default=5000,
+                        help="total requests to send")
+    parser.add_argument("--compare", action="store_true",
+                        help="start the threaded and the ASGI server "
+                             "in turn and load test both")
+    parser.add_argument("--port", type=int, default=8765,
+                        help="port servers listen on with --compare")
+    parser.add_argument("--logins", type=int, default=5,
+                        help="logins in flight at once, 0 for none")
+    parser.add_argument("--login-delay", type=float, default=1.0,
+                        help="seconds the stub identity provider takes")
+    parser.add_argument("--provider-port", type=int, default=8766,
+                        help="port of the stub identity provider")
+    args = parser.parse_args()
+
+    if args.logins:
+        startProvider(args.provider_port, args.login_delay)
+    if args.compare:
+        report = compare(args)
+    else:
+        report = run(args.url, args.paths, args.concurrency, args.requests,
+                     args.logins)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+# Imports from The Python Standard Library
+import sys
+
+# Imports from SQLAlchemy toolkit
+from sqlalchemy import inspect, text
+
+# Imports from "database_setup.py"
+from database_setup import ITEM_SEARCH_DOCUMENT, createTables, engine
+
+
+# Each migration brings the schema from the previous version
+# to its own version. Migrations are applied in order, exactly once,
+# and the current version is stored in the schema_version table.
+# Add new migrations to the end of MIGRATIONS; never edit applied ones.
+
+def addColumn(connection, table, column, ddl):
+    """Adds column to table unless it is already there,
+    e.g. because create_all built the table from the current models"""
+
+    columns = [c["name"] for c in inspect(connection).get_columns(table)]
+    if column not in columns:
+        connection.execute(text(
+            "ALTER TABLE %s ADD COLUMN %s %s" % (table, column, ddl)))
+
+
+def addLookupIndexes(connection):
+    """Version 1: index foreign keys and make user email unique"""
+
+    # Older databases hold duplicate users, one per login.
+    # Point every category and item at the oldest user with
+    # the same email, then drop the duplicates, so that the
+    # unique index on email can be built.
+    for table in ("category", "item"):
+        connection.execute(text(
+            'UPDATE %s SET user_id = ('
+            ' SELECT MIN(u2.id) FROM "user" u1'
+            ' JOIN "user" u2 ON u1.email = u2.email'
+            ' WHERE u1.id = %s.user_id)'
+            ' WHERE user_id IS NOT NULL' % (table, table)))
+    connection.execute(text(
+        'DELETE FROM "user" WHERE id NOT IN ('
+        ' SELECT MIN(id) FROM "user" GROUP BY email)'))
+
+    # Same index names as the ones create_all builds from the models
+    connection.execute(text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_user_email'
+        ' ON "user" (email)'))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_category_user_id'
+        ' ON category (user_id)'))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_item_category_id'
+        ' ON item (category_id)'))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_item_user_id'
+        ' ON item (user_id)'))
+
+
+def addVersionTracking(connection):
+    """Version 2: add updated_at columns and the catalog_version row"""
+
+    # SQLite accepts either name, PostgreSQL only TIMESTAMP
+    timestamp = "TIMESTAMP"
+    addColumn(connection, "category", "updated_at", timestamp)
+    addColumn(connection, "item", "updated_at", timestamp)
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS catalog_version ("
+        " id INTEGER NOT NULL PRIMARY KEY,"
+        " version INTEGER NOT NULL,"
+        " updated_at %s)" % timestamp))
+    connection.execute(text(
+        "INSERT INTO catalog_version (id, version, updated_at)"
+        " SELECT 1, 1, CURRENT_TIMESTAMP"
+        " WHERE NOT EXISTS (SELECT 1 FROM catalog_version WHERE id = 1)"))
+
+
+def addSearchIndex(connection):
+    """Version 3: full-text index over item name and description.
+    item_fts is an external-content FTS5 table: it stores only the
+    index, and triggers keep it in step with every insert, update
+    and delete on item, whichever code path makes them.
+    On PostgreSQL, a GIN expression index over ITEM_SEARCH_DOCUMENT
+    plays the same part and is maintained by the database itself"""
+
+    if connection.dialect.name == "postgresql":
+        connection.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_item_search"
+            " ON item USING GIN (%s)" % ITEM_SEARCH_DOCUMENT))
+        return
+
+    connection.execute(text(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS item_fts USING fts5("
+        " name, description, content='item', content_rowid='id')"))
+    connection.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS item_fts_insert"
+        " AFTER INSERT ON item BEGIN"
+        " INSERT INTO item_fts (rowid, name, description)"
+        " VALUES (new.id, new.name, new.description);"
+        " END"))
+    connection.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS item_fts_delete"
+        " AFTER DELETE ON item BEGIN"
+        " INSERT INTO item_fts (item_fts, rowid, name, description)"
+        " VALUES ('delete', old.id, old.name, old.description);"
+        " END"))
+    connection.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS item_fts_update"
+        " AFTER UPDATE OF name, description ON item BEGIN"
+        " INSERT INTO item_fts (item_fts, rowid, name, description)"
+        " VALUES ('delete', old.id, old.name, old.description);"
+        " INSERT INTO item_fts (rowid, name, description)"
+        " VALUES (new.id, new.name, new.description);"
+        " END"))
+    # Index the items that already exist
+    connection.execute(text(
+        "INSERT INTO item_fts (item_fts) VALUES ('rebuild')"))
+
+
+def addDenormalizedColumns(connection):
+    """Version 4: add item counts and owner names to category,
+    category and owner names to item, and fill them in"""
+
+    addColumn(connection, "category", "item_count",
+              "INTEGER NOT NULL DEFAULT 0")
+    addColumn(connection, "category", "username", "VARCHAR(250)")
+    addColumn(connection, "item", "category_name", "VARCHAR(250)")
+    addColumn(connection, "item", "username", "VARCHAR(250)")
+    repairDenormalizedColumns(connection)
+
+
+def addCascadeDelete(connection):
+    """Version 5: deleting a category deletes its items in the
+    database, in one statement, instead of the ORM loading and
+    deleting every item"""
+
+    if connection.dialect.name == "postgresql":
+        connection.execute(text(
+            "ALTER TABLE item DROP CONSTRAINT IF EXISTS"
+            " item_category_id_fkey"))
+        connection.execute(text(
+            "ALTER TABLE item ADD CONSTRAINT item_category_id_fkey"
+            " FOREIGN KEY (category_id) REFERENCES category (id)"
+            " ON DELETE CASCADE"))
+        return
+
+    # SQLite can not alter a foreign key without rebuilding the
+    # table. A trigger gives older databases the same cascade;
+    # on newer ones it finds the items already gone
+    connection.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS category_delete_items"
+        " AFTER DELETE ON category BEGIN"
+        " DELETE FROM item WHERE category_id = old.id;"
+        " END"))
+
+
+MIGRATIONS = [
+    (1, addLookupIndexes),
+    (2, addVersionTracking),
+    (3, addSearchIndex),
+    (4, addDenormalizedColumns),
+    (5, addCascadeDelete),
+]
+
+
+def repairDenormalizedColumns(connection):
+    """Recomputes item_count and username of every category, and
+    category_name and username of every item, from the tables
+    they copy. Run with --repair if the copies ever drift"""
+
+    connection.execute(text(
+        'UPDATE category SET'
+        ' item_count = (SELECT COUNT(*) FROM item'
+        '  WHERE item.category_id = category.id),'
+        ' username = (SELECT name FROM "user"'
+        '  WHERE "user".id = category.user_id)'))
+    connection.execute(text(
+        'UPDATE item SET'
+        ' category_name = (SELECT name FROM category'
+        '  WHERE category.id = item.category_id),'
+        ' username = (SELECT name FROM "user"'
+        '  WHERE "user".id = item.user_id)'))
+
+
+def getSchemaVersion(connection):
+    """Returns the schema version recorded in the database"""
+
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_version"
+        " (version INTEGER NOT NULL)"))
+    version = connection.execute(text(
+        "SELECT MAX(version) FROM schema_version")).scalar()
+    return version or 0
+
+
+def upgrade(engine=engine):
+    """Creates missing tables, then applies every pending migration,
+    each in its own transaction. Returns the resulting schema version"""
+
+    createTables(engine)
+    with engine.begin() as connection:
+        version = getSchemaVersion(connection)
+
+    for target, migration in MIGRATIONS:
+        if target <= version:
+            continue
+        with engine.begin() as connection:
+            migration(connection)
+            connection.execute(text(
+                "INSERT INTO schema_version (version) VALUES (:version)"),
+                {"version": target})
+        print("Applied migration %d: %s" % (target, migration.__name__))
+        version = target
+
+    return version
+
+
+if __name__ == "__main__":
+    print("Schema is at version %d" % upgrade())
+    if "--repair" in sys.argv[1:]:
+        with engine.begin() as connection:
+            repairDenormalizedColumns(connection)
+        print("Recomputed item counts and names")
@@ -1,48 +1,171 @@
 #!/usr/bin/env python3
 
 # Imports from Flask
-from flask import Flask
+from flask import Flask, has_app_context, has_request_context
 from flask import request, render_template, redirect, url_for
 from flask import jsonify, flash
 from flask import session as login_session
 from flask import make_response
+from flask import g
+from flask import Response, stream_with_context
 
 # Imports from "database_setup.py"
-from database_setup import Base, Category, Item, User
+from database_setup import Base, makeEngine
 
 # Imports from SQLAlchemy toolkit
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import event
+from sqlalchemy.orm import scoped_session, sessionmaker
 
 # Import from The Python Standard Library
-from oauth2client.client import flow_from_clientsecrets
-from oauth2client.client import FlowExchangeError
-import httplib2
+import codecs
+import functools
 import json
-import requests
+import sys
+import zlib
 
 # Import from "helper_functions.py"
 from helper_functions import *
 
+# Import settings from "config.py"
+import config
+
+# Import from "bulk_import.py"
+from bulk_import import FORMATS, importRows, parseRows
+
+# Import from "session_store.py"
+from session_store import makeSessionInterface
+
+# Import from "instrumentation.py"
+from instrumentation import initInstrumentation
+
+# Import from "compression.py"
+from compression import initCompression
+
+# Import from "static_assets.py"
+from static_assets import initStaticAssets
+
 # Connect to database,
 # Create session
-engine = create_engine("sqlite:///item_catelog.db")
+engine = makeEngine()
+# Separate pool of read-only connections for GET requests,
+# so reads never queue behind connections busy writing.
+# Points at the read replica, if one is configured
+read_engine = makeEngine(config.DATABASE_REPLICA_URL, readonly=True)
 # Bind schema constructs(mapper code) to engine
 Base.metadata.bind = engine
 # Create a configured Session class
 DBSession = sessionmaker(bind=engine)
-# Create a session
-session = DBSession()
 
 
-# Create Flask instance
+def newSession():
+    """Returns new session, bound to the read-only engine
+    while handling GET and HEAD requests"""
+
+    if has_request_context() and request.method in ("GET", "HEAD"):
+        return DBSession(bind=read_engine)
+    return DBSession()
+
+
+# Create a session registry.
+# Each request (thread) gets its own session,
+# which is released when the request ends
+session = scoped_session(newSession)
+
+
+# Create Flask instance.
+# Importing this module only declares the app and its routes:
+# it creates no tables (see "migrate.py") and opens no files;
+# create_app() makes the app ready to serve
 app = Flask(__name__)
+app.config.from_object(config)
+_app_ready = False
+
+
+def create_app():
+    """Returns the app, ready to serve. Safe to call more than once.
+    1. Keeps login_session on the server,
+    only its id goes in the cookie,
+    2. Records per-request timings and metrics, if enabled,
+    3. Compresses large HTML and JSON responses,
+    4. Serves static files at fingerprinted, long-cached URLs"""
+
+    global _app_ready
+    if not _app_ready:
+        app.session_interface = makeSessionInterface()
+        if config.INSTRUMENTATION:
+            initInstrumentation(app, engine, read_engine)
+        initCompression(app)
+        initStaticAssets(app)
+        _app_ready = True
+    return app
+
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    """Releases the request's database session back to the pool,
+    rolling back anything left uncommitted"""
+
+    session.remove()
+
+
+def afterFork():
+    """Resets state a worker process must not share with the process
+    it was forked from. Called by "gunicorn.conf.py" in each worker.
+    Caches and parsed settings are kept; they stay valid and warm"""
+
+    # Pooled connections belong to the parent: forget them, unclosed,
+    # so the parent's sockets are left alone
+    engine.dispose(close=False)
+    read_engine.dispose(close=False)
+    # New session store connection and expiry sweeper thread
+    app.session_interface = makeSessionInterface()
+    # OAuth libraries load on first login; reset only if loaded
+    if "google_auth" in sys.modules:
+        sys.modules["google_auth"].resetHttpSession()
+
 
-# Store client id in a variable
-CLIENT_ID = json.loads(
-    open('client_secrets.json', 'r').read())['web']['client_id']
 APPLICATION_NAME = "Item Catelog"
 
+# Upper bound on SQL statements per request. "benchmark.py" fails
+# a run if any route exceeds it; in debug mode, every request that
+# does is logged. Listing routes read category and owner names stored
+# on each row, so this must not grow with the number of rows.
+MAX_QUERIES_PER_REQUEST = 8
+
+
+def count_request_query(conn, cursor, statement, *args):
+    """Counts a statement against the request that runs it, if its
+    count was started. Requests run in parallel threads, each with
+    its own g, so statements of other requests are not counted"""
+
+    if has_app_context() and "query_count" in g:
+        g.query_count += 1
+
+
+# Registered once; the listener itself tells requests apart
+for query_engine in (engine, read_engine):
+    event.listen(query_engine, "before_cursor_execute", count_request_query)
+
+
+@app.before_request
+def start_query_count():
+    """In debug mode, start counting SQL statements for this request"""
+
+    if app.debug:
+        g.query_count = 0
+
+
+@app.after_request
+def check_query_count(response):
+    """In debug mode, logs requests that ran more SQL statements
+    than their query budget"""
+
+    query_count = g.pop("query_count", None)
+    if query_count is not None and query_count > MAX_QUERIES_PER_REQUEST:
+        app.logger.error("%s ran %d queries (limit %d)",
+                         request.path, query_count, MAX_QUERIES_PER_REQUEST)
+    return response
+
 
 # Route to login page "http://localhost:5000/login/"
 @app.route("/login")
@@ -58,7 +181,7 @@ def show_login():
         return redirect(url_for("index"))
 
     # Get categories
-    categories = getCategoryAll(session)
+    categories = getCategoryList(session)
     # Create anti forgery state token
     state = AFStateToken()
     # Store anti forgery state token in session
@@ -75,13 +198,13 @@ def gconnect():
     """Authentication and authorization:
     1. Validate state token
     2. Obtain authorization code
-    3. Exchange authorization code with access credentials from provider
-    4. Check if access token is valid.
-    5. Check if access token is for correct user,
-    and for correct client(app)
-    6. Check if user is already connected,
+    3. Exchange authorization code with access and ID tokens
+    from provider (the only outbound call)
+    4. Verify ID token locally against cached signing certificates:
+    signature, expiry, issuer, and that it was issued to this app
+    5. Check if user is already connected,
     otherwise store the user and access credentials in login session
-    7. Check if user already exists,
+    6. Check if user already exists,
     otherwise create new user"""
 
     # Validate state token
@@ -92,52 +215,28 @@ def gconnect():
         return response
 
     # Obtain the authorization code
-    auth_code = request.data
-
-    try:
-        # Upgrade authorization code into credentials object
-        # 1. Create flow object
-        # 2. Exchange authorization code with credentials object
-        # The credentials object contains the access token
-        oauth_flow = flow_from_clientsecrets("client_secrets.json", scope="")
-        oauth_flow.redirect_uri = "postmessage"
-        credentials = oauth_flow.step2_exchange(auth_code)
-    except FlowExchangeError:
-        response = make_response(
-            json.dumps("Failed to upgrade the authorization code."), 401)
-        response.headers["Content-Type"] = "application/json"
-        return response
-
-    # Check that access token is valid
-    access_token = credentials.access_token
-    url = ("https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s"
-           % access_token)
-    h = httplib2.Http()
-    result = json.loads(h.request(url, 'GET')[1].decode())
-    # If there was an error in access token info, abort
-    if result.get("error") is not None:
-        response = make_response(
-            json.dumps(result.get("error")), 500)
-        response.headers["Content-Type"] = "application/json"
-        return response
+    auth_code = request.data.decode("utf-8")
 
-    # Verify that the access token is for intended user
-    gplus_id = credentials.id_token["sub"]
-    if result["user_id"] != gplus_id:
-        response = make_response(
-            json.dumps(
-                "Token's user id doesn't match the given user id."), 401)
-        response.headers["Content-Type"] = "application/json"
-        return response
+    # Load OAuth libraries on first login, not at startup
+    from google_auth import AuthError, exchangeCode
 
-    # Verify that the access token is valid for this app
-    if result["issued_to"] != CLIENT_ID:
-        response = make_response(
-            json.dumps("Token's client id doesn't match the app's client id."))
+    try:
+        # Under "asgi.py" the code was already exchanged, on its event
+        # loop; else upgrade authorization code into access token and
+        # verified ID token claims here
+        exchanged = request.environ.get("catalog.exchanged_code")
+        if exchanged is None:
+            exchanged = exchangeCode(auth_code)
+        if isinstance(exchanged, AuthError):
+            raise exchanged
+        access_token, claims = exchanged
+    except AuthError as e:
+        response = make_response(json.dumps(str(e)), 401)
         response.headers["Content-Type"] = "application/json"
         return response
 
     # Check if the user is already connected
+    gplus_id = claims["sub"]
     stored_access_token = login_session.get("access_token")
     stored_gplus_id = login_session.get("gplus_id")
 
@@ -147,26 +246,21 @@ def gconnect():
         response.headers["Content-Type"] = "application/json"
         return response
 
+    # The user is now logged in: continue under a new session id,
+    # so an id handed out before login is worth nothing
+    login_session.regenerate()
+
     # Store the access token and user id in session for later use
-    login_session["access_token"] = credentials.access_token
+    login_session["access_token"] = access_token
     login_session["gplus_id"] = gplus_id
 
-    # Get user info
-    userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    params = {"access_token": credentials.access_token, "alt": "json"}
-    answer = requests.get(userinfo_url, params=params)
-
-    data = answer.json()
+    # Store user info from the ID token in login session
+    login_session["username"] = claims.get("name", claims["email"])
+    login_session["picture"] = claims.get("picture", "")
+    login_session["email"] = claims["email"]
 
-    # Store user info in login session
-    login_session["username"] = data["name"]
-    login_session["picture"] = data["picture"]
-    login_session["email"] = data["email"]
-
-    # Check if user exists
-    user_id = getUserId(login_session["email"], session)
-    if not user_id:
-        user_id = createUser(login_session, session)
+    # Get existing user, or create new user
+    user_id = getOrCreateUser(login_session, session)
 
     # Store user id to login session
     login_session["user_id"] = user_id
@@ -198,15 +292,17 @@ def gdisconnect():
         response.headers["Content-Type"] = "application/json"
         return response
 
-    # If access token exists, check that it is valid and can be revoked
-    url = ("https://accounts.google.com/o/oauth2/revoke?token=%s"
-           % login_session['access_token'])
-
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[0]
+    # Load OAuth libraries on first use, not at startup
+    from google_auth import revokeToken
 
-    # If access token is valid and can be revoked,
-    if result["status"] == "200":
+    # If access token exists, revoke it, unless "asgi.py" already did.
+    revoked = request.environ.get("catalog.revoked_token")
+    if revoked is not None and revoked[0] == access_token:
+        revoked = revoked[1]
+    else:
+        revoked = revokeToken(access_token)
+    # If access token is valid and was revoked,
+    if revoked:
         # Delete user info and access credentials from login session
         del login_session["access_token"]
         del login_session["gplus_id"]
@@ -214,6 +310,8 @@ def gdisconnect():
         del login_session["email"]
         del login_session["picture"]
         del login_session["user_id"]
+        # Logged out: the old session id must not log anyone back in
+        login_session.regenerate()
 
         response = make_response(
             json.dumps("Successfully Disconnected!"), 200)
@@ -238,23 +336,153 @@ def logout():
         return redirect(url_for("gdisconnect"))
 
 
+def getPageArgs():
+    """Returns (limit, after_id, all) from the query string,
+    by the rules of parsePageArgs"""
+
+    return parsePageArgs(request.args.get("limit"),
+                         request.args.get("after_id"),
+                         request.args.get("all"))
+
+
+def nextPageUrl(endpoint, rows, has_more, limit, **values):
+    """Returns URL of the page after rows, or None on the last page"""
+
+    if not has_more:
+        return None
+    return url_for(endpoint, limit=limit, after_id=rows[-1].id,
+                   _external=True, **values)
+
+
+def jsonResponse(**values):
+    """Returns JSON response for values, encoded by dumpsJSON.
+    Listings pass rows from serializeRows, not ORM objects"""
+
+    return Response(dumpsJSON(values), mimetype="application/json")
+
+
+def jsonNotFound():
+    """Returns 404 JSON response for a missing category or item"""
+
+    response = make_response(json.dumps("Not found"), 404)
+    response.headers["Content-Type"] = "application/json"
+    return response
+
+
+def getItemListPage(endpoint, category_id=None):
+    """Returns (items, prev_url, next_url) for a page of an HTML item
+    listing, read from limit, after_id and before_id in the query string.
+    With category_id, lists only that category's items, and the
+    endpoint's URLs take category_id too"""
+
+    values = {}
+    if category_id is not None:
+        values["category_id"] = category_id
+    limit, after_id, fetch_all = getPageArgs()
+    before_id = request.args.get("before_id", type=int)
+    items, has_more = getItemPage(session, limit, after_id, category_id,
+                                  before_id)
+
+    if before_id is not None:
+        # Paging backwards: more rows precede, and before_id follows
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = after_id is not None, has_more
+
+    prev_url = next_url = None
+    if items:
+        if has_prev:
+            prev_url = url_for(endpoint, limit=limit,
+                               before_id=items[0].id, **values)
+        if has_next:
+            next_url = url_for(endpoint, limit=limit,
+                               after_id=items[-1].id, **values)
+    elif after_id is not None or before_id is not None:
+        # Cursor points past the end, offer the first page
+        prev_url = url_for(endpoint, limit=limit, **values)
+    return items, prev_url, next_url
+
+
+def cachedForAnonymous(view):
+    """Serves a page view from page_cache for visitors who are not
+    logged in. Pages are keyed by endpoint, path and query string,
+    and catalog version. Logged in users, and visitors with flashed
+    messages waiting, always get a fresh render"""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if "username" in login_session or "_flashes" in login_session:
+            return view(*args, **kwargs)
+
+        version, updated_at = getCatalogVersion(read_engine)
+        key = (request.endpoint, request.full_path, version)
+        page = page_cache.get(key)
+        if page is None:
+            page = view(*args, **kwargs)
+            # Only cache rendered HTML, not redirects or errors
+            if isinstance(page, str):
+                page_cache.set(key, page)
+        return page
+
+    return wrapper
+
+
 @app.route("/", methods=["GET"])
+@cachedForAnonymous
 def index():
-    """Displays the list of all categories and all items"""
+    """Displays the list of all categories and a page of items"""
 
     # Set login status
     logged_in = False
     if "username" in login_session:
         logged_in = True
 
-    # Get all items and categories
-    categories = getCategoryAll(session)
-    items = getItemAll(session)
+    # Get all categories and a page of items
+    categories = getCategoryList(session)
+    items, prev_url, next_url = getItemListPage("index")
 
     # Render index page
     return render_template("index.html",
                            categories=categories,
                            items=items,
+                           prev_url=prev_url,
+                           next_url=next_url,
+                           logged_in=logged_in)
+
+
+def getSearchArgs():
+    """Returns (terms, page) from the query string, page counts from 1"""
+
+    terms = request.args.get("q", "").strip()
+    page = max(1, request.args.get("page", 1, type=int))
+    return terms, page
+
+
+@app.route("/search/", methods=["GET"])
+def search():
+    """Displays items whose name or description match the query,
+    best match first"""
+
+    # Set login status
+    logged_in = False
+    if "username" in login_session:
+        logged_in = True
+
+    # Get search terms and page number
+    terms, page = getSearchArgs()
+    limit = config.SEARCH_PAGE_SIZE
+    # Get all categories
+    categories = getCategoryList(session)
+    # Get a page of matching items
+    items, has_more = searchItems(session, terms, limit, (page - 1) * limit)
+
+    # Render search results
+    return render_template("item/search_item.html",
+                           categories=categories,
+                           items=items,
+                           search_terms=terms,
+                           page=page,
+                           has_more=has_more,
                            logged_in=logged_in)
 
 
@@ -268,7 +496,7 @@ def create_category():
         return redirect(url_for("show_login"))
 
     # Get all categories
-    categories = getCategoryAll(session)
+    categories = getCategoryList(session)
 
     if request.method == "GET":
         # Render page to create new category
@@ -299,7 +527,7 @@ def update_category(category_id):
         return redirect(url_for("show_login"))
 
     # Get all categories
-    categories = getCategoryAll(session)
+    categories = getCategoryList(session)
     # Get category by id
     category = getCategoryOne(session, category_id)
 
@@ -341,7 +569,7 @@ def delete_category(category_id):
         return redirect(url_for("show_login"))
 
     # Get all categories
-    categories = getCategoryAll(session)
+    categories = getCategoryList(session)
     # Get category by id
     category = getCategoryOne(session, category_id)
 
@@ -370,8 +598,9 @@ def delete_category(category_id):
 
 
 @app.route("/category/<int:category_id>/item/", methods=["GET"])
+@cachedForAnonymous
 def read_item_by_category(category_id):
-    """Display items for given category"""
+    """Display a page of items for given category"""
 
     # Set login status
     logged_in = False
@@ -379,17 +608,20 @@ def read_item_by_category(category_id):
         logged_in = True
 
     # Get all categories
-    categories = getCategoryAll(session)
+    categories = getCategoryList(session)
     # Get category by id
     category = getCategoryOne(session, category_id)
-    # Get items by category
-    items = getItemByCategory(session, category_id)
+    # Get a page of items by category
+    items, prev_url, next_url = getItemListPage("read_item_by_category",
+                                                category_id)
     # Check if user is creator
     user_is_creator = category.user_id == login_session.get("user_id")
 
     # Return page that displays items by category
     return render_template("item/read_item_by_category.html",
                            items=items,
+                           prev_url=prev_url,
+                           next_url=next_url,
                            categories=categories,
                            category_name=category.name,
                            category_id=category_id,
@@ -398,6 +630,7 @@ def read_item_by_category(category_id):
 
 
 @app.route("/category/<int:category_id>/item/<int:item_id>/description/")
+@cachedForAnonymous
 def read_item_description(category_id, item_id):
     """Display item description for given item"""
 
@@ -407,12 +640,12 @@ def read_item_description(category_id, item_id):
         logged_in = True
 
     # Get all categories from database
-    categories = getCategoryAll(session)
+    categories = getCategoryList(session)
     # Get category by id
     category = getCategoryOne(session, category_id)
     # Get item by id
-    items = session.query(Item).filter_by(id=item_id)
-    item = items.one()
+    item = getItemOne(session, item_id)
+    items = [item]
 
     # Check if user is creator
     user_is_creator = item.user_id == login_session.get("user_id")
@@ -440,7 +673,7 @@ def create_item(category_id):
         return redirect(url_for("show_login"))
 
     # Get all categories
-    categories = getCategoryAll(session)
+    categories = getCategoryList(session)
 
     if request.method == "GET":
         # Render page to create item
@@ -476,7 +709,7 @@ def update_item(category_id, item_id):
         return redirect(url_for("show_login"))
 
     # Get all categories
-    categories = getCategoryAll(session)
+    categories = getCategoryList(session)
     # Get item by id
     item = getItemOne(session, item_id)
 
@@ -524,7 +757,7 @@ def delete_item(category_id, item_id):
         return redirect(url_for("show_login"))
 
     # Get all categories
-    categories = getCategoryAll(session)
+    categories = getCategoryList(session)
     # Get item by id
     item = getItemOne(session, item_id)
 
@@ -553,59 +786,238 @@ def delete_item(category_id, item_id):
                                 category_id=category_id))
 
 
+@app.route("/cache/JSON", methods=["GET"])
+def cache_json():
+    """Returns JSON object with hit and miss counters of the caches"""
+
+    return jsonify(Categories=category_cache.stats,
+                   Pages=page_cache.stats,
+                   Users=user_cache.stats)
+
+
+def notModified(etag, updated_at):
+    """Returns True if the client's cached copy, identified by
+    If-None-Match or If-Modified-Since, is still current"""
+
+    return isNotModified(request.if_none_match, request.if_modified_since,
+                         etag, updated_at)
+
+
+def conditional(view):
+    """Adds ETag and Last-Modified headers derived from the catalog
+    version to a JSON view, and answers 304 Not Modified without
+    running the view (or touching the ORM) if the client is current"""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        version, updated_at = getCatalogVersion(read_engine)
+        etag = catalogETag(version)
+
+        if notModified(etag, updated_at):
+            response = Response(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+
+        response.set_etag(etag)
+        if updated_at is not None:
+            response.last_modified = updated_at
+        # Clients may keep the response but must revalidate it
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    return wrapper
+
+
+@app.route("/import/<any(category, item):kind>/", methods=["POST"])
+def bulk_import(kind):
+    """Allows logged in users to import categories or items in bulk.
+    The body is CSV, JSON (one array) or NDJSON, chosen by ?format=
+    or by Content-Type. Returns JSON report of inserted rows and
+    of rows rejected by validation"""
+
+    # If user is not logged in,
+    if "username" not in login_session:
+        response = make_response(
+            json.dumps("Current user is not connected."), 401)
+        response.headers["Content-Type"] = "application/json"
+        return response
+
+    # Get format from query string or Content-Type
+    format = request.args.get("format")
+    if format is None:
+        format = {"text/csv": "csv",
+                  "application/json": "json",
+                  "application/x-ndjson": "ndjson"}.get(request.mimetype)
+    if format not in FORMATS:
+        response = make_response(
+            json.dumps("Unknown format, use csv, json or ndjson."), 400)
+        response.headers["Content-Type"] = "application/json"
+        return response
+
+    # Read body as text, lazily for csv and ndjson
+    stream = codecs.getreader("utf-8")(request.stream)
+    try:
+        report = importRows(session, kind, parseRows(stream, format),
+                            login_session["user_id"])
+    except ValueError as e:
+        response = make_response(json.dumps("Malformed body: %s" % e), 400)
+        response.headers["Content-Type"] = "application/json"
+        return response
+
+    # Return JSON report
+    return jsonify(report)
+
+
 @app.route("/category/JSON", methods=["GET"])
+@conditional
 def categories_json():
-    """Returns JSON object with all categories"""
-
-    # Get all categories
-    categories = getCategoryAll(session)
-    # Return JSON object
-    return jsonify(Categories=[c.serialize for c in categories])
+    """Returns JSON object with a page of categories,
+    or all categories if requested with ?all=true"""
+
+    limit, after_id, fetch_all = getPageArgs()
+    if fetch_all:
+        # Get columns of all categories
+        categories = getCategoryAll(session, CATEGORY_FIELDS)
+        # Return JSON object
+        return jsonResponse(
+            Categories=serializeRows(CATEGORY_FIELDS, categories))
+
+    # Get columns of a page of categories
+    categories, has_more = getCategoryPage(session, limit, after_id,
+                                           CATEGORY_FIELDS)
+    # Return JSON object with link to next page
+    return jsonResponse(
+        Categories=serializeRows(CATEGORY_FIELDS, categories),
+        next=nextPageUrl("categories_json", categories, has_more, limit))
+
+
+@app.route("/search/JSON", methods=["GET"])
+def search_json():
+    """Returns JSON object with a page of items matching ?q=,
+    best match first"""
+
+    # Get search terms and page number
+    terms, page = getSearchArgs()
+    limit = config.SEARCH_PAGE_SIZE
+    # Get a page of matching items
+    items, has_more = searchItems(session, terms, limit, (page - 1) * limit)
+    # Return JSON object with link to next page
+    next_url = None
+    if has_more:
+        next_url = url_for("search_json", q=terms, page=page + 1,
+                           _external=True)
+    return jsonify(Items=[i.serialize for i in items], next=next_url)
 
 
 @app.route("/category/<int:category_id>/JSON", methods=["GET"])
+@conditional
 def category_json(category_id):
     """Returns JSON object of category with given id"""
 
     # Get category by id
     category = getCategoryOne(session, category_id)
+    # If no category found,
+    if category is None:
+        return jsonNotFound()
     # Return JSON object
     return jsonify(Category=category.serialize)
 
 
 @app.route("/item/JSON", methods=["GET"])
+@conditional
 def items_JSON():
-    """Returns JSON object with all items"""
-
-    # Get all items
-    items = getItemAll(session)
-    # Return JSON object
-    return jsonify(Items=[i.serialize for i in items])
+    """Returns JSON object with a page of items,
+    or all items if requested with ?all=true"""
+
+    limit, after_id, fetch_all = getPageArgs()
+    if fetch_all:
+        # Get columns of all items
+        items = getItemAll(session, ITEM_FIELDS)
+        # Return JSON object
+        return jsonResponse(Items=serializeRows(ITEM_FIELDS, items))
+
+    # Get columns of a page of items
+    items, has_more = getItemPage(session, limit, after_id,
+                                  fields=ITEM_FIELDS)
+    # Return JSON object with link to next page
+    return jsonResponse(
+        Items=serializeRows(ITEM_FIELDS, items),
+        next=nextPageUrl("items_JSON", items, has_more, limit))
+
+
+@app.route("/item/NDJSON", methods=["GET"])
+def items_NDJSON():
+    """Streams all items as newline-delimited JSON, one item per line.
+    Memory use does not depend on the number of items.
+    With ?gzip=true the stream is gzip-compressed on the fly"""
+
+    keys = [key for key, column in ITEM_FIELDS]
+
+    def generate():
+        # Read item columns in batches from a server-side cursor
+        for row in iterItemAll(session, config.EXPORT_BATCH_SIZE,
+                               ITEM_FIELDS):
+            yield dumpsJSON(dict(zip(keys, row))) + b"\n"
+
+    def compress(lines):
+        # wbits=16+MAX_WBITS writes gzip header and trailer
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for line in lines:
+            chunk = compressor.compress(line)
+            if chunk:
+                yield chunk
+        yield compressor.flush()
+
+    # Keep request context, and so the session, alive while streaming
+    body = stream_with_context(generate())
+    if request.args.get("gzip", "").lower() != "true":
+        return Response(body, mimetype="application/x-ndjson")
+    response = Response(compress(body), mimetype="application/x-ndjson")
+    response.headers["Content-Encoding"] = "gzip"
+    return response
 
 
 @app.route("/item/<int:item_id>/JSON", methods=["GET"])
 @app.route("/category/<int:category_id>/item/<int:item_id>/JSON",
            methods=["GET"])
+@conditional
 def item_JSON(item_id, category_id=None):
     """Returns JSON object of item with given id"""
 
     # Get item by id
     item = getItemOne(session, item_id)
+    # If no item found,
+    if item is None:
+        return jsonNotFound()
     # Return JSON object
     return jsonify(Item=item.serialize)
 
 
 @app.route("/category/<int:category_id>/item/JSON", methods=["GET"])
+@conditional
 def category_items_json(category_id):
-    """Return JSON object of items with given category id"""
-
-    # Get items by category id
-    items = getItemByCategory(session, category_id)
-    # Return JSON object
-    return jsonify(Items=[i.serialize for i in items])
+    """Return JSON object with a page of items with given category id,
+    or all of them if requested with ?all=true"""
+
+    limit, after_id, fetch_all = getPageArgs()
+    if fetch_all:
+        # Get columns of items by category id
+        items = getItemByCategory(session, category_id, ITEM_FIELDS)
+        # Return JSON object
+        return jsonResponse(Items=serializeRows(ITEM_FIELDS, items))
+
+    # Get columns of a page of items by category id
+    items, has_more = getItemPage(session, limit, after_id, category_id,
+                                  fields=ITEM_FIELDS)
+    # Return JSON object with link to next page
+    return jsonResponse(
+        Items=serializeRows(ITEM_FIELDS, items),
+        next=nextPageUrl("category_items_json", items, has_more, limit,
+                         category_id=category_id))
 
 
 if __name__ == "__main__":
+    create_app()
     # key to be changed later to something secure
     app.secret_key = "somekey"
     # To debug, Set to True, otherwise False
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+# Imports from The Python Standard Library
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Imports from Flask
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+# Import settings from "config.py"
+import config
+
+# Serializes session dicts the way Flask's cookie sessions do,
+# so tuples (e.g. flashed messages) survive the round trip
+serializer = TaggedJSONSerializer()
+
+
+def newSessionId():
+    """Returns new random session id"""
+
+    return secrets.token_urlsafe(32)
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session whose data lives in a store; the cookie holds only sid"""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        # Id this session was stored under before regenerate()
+        self.replaced_sid = None
+
+    def regenerate(self):
+        """Moves the session to a new random id, keeping its data.
+        The old id stops working when the response is saved.
+        Call whenever the user logs in or out, so an id someone
+        learned before (e.g. by visiting /login) never becomes
+        a logged in session"""
+
+        if not self.new:
+            self.replaced_sid = self.sid
+        self.sid = newSessionId()
+        self.new = True
+        self.modified = True
+
+
+class MemoryStore(object):
+    """Keeps sessions in this process:
+    1. At most maxsize sessions, least recently used go first,
+    2. Only suitable when a single process serves the app"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        """Returns session data for sid, or None if missing or expired"""
+
+        with self._lock:
+            entry = self._entries.get(sid)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._entries[sid]
+                return None
+            self._entries.move_to_end(sid)
+            return serializer.loads(entry[1])
+
+    def set(self, sid, data, expires):
+        """Stores session data for sid until expires (epoch seconds)"""
+
+        with self._lock:
+            self._entries[sid] = (expires, serializer.dumps(data))
+            self._entries.move_to_end(sid)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, sid):
+        """Removes session sid"""
+
+        with self._lock:
+            self._entries.pop(sid, None)
+
+    def sweep(self):
+        """Removes expired sessions"""
+
+        now = time.time()
+        with self._lock:
+            expired = [sid for sid, entry in self._entries.items()
+                       if entry[0] <= now]
+            for sid in expired:
+                del self._entries[sid]
+
+
+class SQLiteStore(object):
+    """Keeps sessions in an SQLite file, shared by every process
+    on the host. Each thread uses its own connection"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        connection = self._connect()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS session ("
+            " sid TEXT NOT NULL PRIMARY KEY,"
+            " data TEXT NOT NULL,"
+            " expires REAL NOT NULL)")
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS ix_session_expires"
+            " ON session (expires)")
+        connection.commit()
+
+    def _connect(self):
+        """Returns this thread's connection, opening it if needed"""
+
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            self._local.connection = connection
+        return connection
+
+    def get(self, sid):
+        """Returns session data for sid, or None if missing or expired"""
+
+        row = self._connect().execute(
+            "SELECT data FROM session WHERE sid = ? AND expires > ?",
+            (sid, time.time())).fetchone()
+        if row is None:
+            return None
+        return serializer.loads(row[0])
+
+    def set(self, sid, data, expires):
+        """Stores session data for sid until expires (epoch seconds)"""
+
+        connection = self._connect()
+        connection.execute(
+            "INSERT OR REPLACE INTO session (sid, data, expires)"
+            " VALUES (?, ?, ?)", (sid, serializer.dumps(data), expires))
+        connection.commit()
+
+    def delete(self, sid):
+        """Removes session sid"""
+
+        connection = self._connect()
+        connection.execute("DELETE FROM session WHERE sid = ?", (sid,))
+        connection.commit()
+
+    def sweep(self):
+        """Removes expired sessions"""
+
+        connection = self._connect()
+        connection.execute("DELETE FROM session WHERE expires <= ?",
+                           (time.time(),))
+        connection.commit()
+
+
+class ServerSessionInterface(SessionInterface):
+    """Flask session interface backed by a server-side store.
+    The cookie carries only a random session id, so it stays small
+    and needs no signature check on every request"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.store.get(sid)
+            if data is not None:
+                return ServerSession(data, sid=sid)
+        # No cookie, or session expired: start a new one
+        return ServerSession(sid=newSessionId(), new=True)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        # Forget data kept under the id the session had before
+        # regenerate(); the client is sent the new id below
+        if session.replaced_sid is not None:
+            self.store.delete(session.replaced_sid)
+
+        # If session was emptied, forget it
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+            if session.modified and (not session.new or
+                                     session.replaced_sid is not None):
+                response.delete_cookie(self.get_cookie_name(app),
+                                       domain=domain, path=path)
+            return
+
+        # Only write when something changed
+        if not session.modified:
+            return
+
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        self.store.set(session.sid, dict(session), time.time() + lifetime)
+        # Existing clients already hold the id
+        if session.new:
+            response.set_cookie(self.get_cookie_name(app), session.sid,
+                                max_age=int(lifetime),
+                                httponly=self.get_cookie_httponly(app),
+                                secure=self.get_cookie_secure(app),
+                                domain=domain, path=path)
+
+
+def startSweeper(store, interval):
+    """Starts daemon thread that removes expired sessions
+    from store every interval seconds"""
+
+    def sweep():
+        while True:
+            time.sleep(interval)
+            try:
+                store.sweep()
+            except Exception as e:
+                # Keep sweeping; the next run may succeed
+                print("Session sweep failed: %s" % e)
+
+    thread = threading.Thread(target=sweep, name="session-sweeper")
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def makeSessionInterface():
+    """Returns session interface for config.SESSION_BACKEND
+    ("memory" or "sqlite") and starts its expiry sweeper"""
+
+    if config.SESSION_BACKEND == "memory":
+        store = MemoryStore(config.SESSION_MAX_ENTRIES)
+    elif config.SESSION_BACKEND == "sqlite":
+        store = SQLiteStore(config.SESSION_SQLITE_PATH)
+    else:
+        raise ValueError("Unknown session backend %r"
+                         % config.SESSION_BACKEND)
+    startSweeper(store, config.SESSION_SWEEP_INTERVAL)
+    return ServerSessionInterface(store)
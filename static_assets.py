@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# Imports from The Python Standard Library
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+
+# Imports from Flask
+from flask import request, send_from_directory
+
+# Import from "compression.py"
+from compression import brotli
+
+# Fingerprinted URLs change whenever the file does,
+# so clients may keep what they fetched for a year
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Content codings of precompressed variants, best first,
+# and the suffixes of their files
+VARIANTS = (("br", ".br"), ("gzip", ".gz"))
+# Files smaller than this are not worth precompressing
+PRECOMPRESS_MIN_SIZE = 256
+
+
+def isVariant(path):
+    """Returns True for a precompressed variant of another file"""
+
+    return any(path.endswith(suffix) for encoding, suffix in VARIANTS)
+
+
+def buildManifest(folder):
+    """Returns dict of every file path under folder, relative to it,
+    to its fingerprinted path, e.g. css/style.css to
+    css/style.0123456789ab.css. The fingerprint is the start of
+    the SHA-256 of the file's content"""
+
+    manifest = {}
+    for directory, subdirectories, files in os.walk(folder):
+        for name in files:
+            full_path = os.path.join(directory, name)
+            path = os.path.relpath(full_path, folder).replace(os.sep, "/")
+            if isVariant(path):
+                continue
+            with open(full_path, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()[:12]
+            root, extension = os.path.splitext(path)
+            manifest[path] = "%s.%s%s" % (root, digest, extension)
+    return manifest
+
+
+def removeVariants(folder, path, keep=None):
+    """Removes precompressed variants of path, built from any earlier
+    content of the file, except the variants of fingerprinted path keep"""
+
+    directory, name = os.path.split(os.path.join(folder, path))
+    root, extension = os.path.splitext(name)
+    pattern = re.compile(re.escape(root) + r"(\.[0-9a-f]{12})?" +
+                         re.escape(extension) + r"\.(br|gz)$")
+    keep = keep and os.path.basename(keep)
+    for other in os.listdir(directory):
+        if (pattern.match(other) and
+                not (keep and other.startswith(keep + "."))):
+            os.remove(os.path.join(directory, other))
+
+
+def precompress(folder):
+    """Writes gzip and, if brotli is installed, brotli variants
+    of every text file under folder, at the highest levels.
+    Variants are named after the fingerprinted path, e.g.
+    css/style.0123456789ab.css.gz, so they are only ever served for
+    the content they were built from. Variants of earlier content,
+    and variants that would not be smaller, are removed.
+    Returns number of variants written"""
+
+    written = 0
+    for path, fingerprinted in buildManifest(folder).items():
+        full_path = os.path.join(folder, path)
+        variant_path = os.path.join(folder, fingerprinted)
+        removeVariants(folder, path, keep=fingerprinted)
+        media_type = mimetypes.guess_type(path)[0] or ""
+        if not (media_type.startswith("text/") or
+                media_type in ("application/javascript", "image/svg+xml")):
+            continue
+        with open(full_path, "rb") as f:
+            data = f.read()
+
+        for encoding, suffix in VARIANTS:
+            if encoding == "br":
+                if brotli is None:
+                    continue
+                compressed = brotli.compress(data, quality=11)
+            else:
+                # mtime=0 so unchanged files give identical variants
+                compressed = gzip.compress(data, 9, mtime=0)
+            if (len(data) < PRECOMPRESS_MIN_SIZE or
+                    len(compressed) >= len(data)):
+                if os.path.exists(variant_path + suffix):
+                    os.remove(variant_path + suffix)
+                continue
+            with open(variant_path + suffix, "wb") as f:
+                f.write(compressed)
+            written += 1
+    return written
+
+
+def initStaticAssets(app):
+    """Serves files under the static folder at fingerprinted URLs:
+    1. url_for("static", filename=...) returns the fingerprinted URL,
+    2. Fingerprinted URLs are cached by clients as immutable,
+    3. Precompressed variants are served to clients accepting them,
+    if they were built from the file's current content.
+    Plain URLs keep working, with the default caching"""
+
+    folder = app.static_folder
+    manifest = buildManifest(folder)
+    originals = dict((fingerprinted, path)
+                     for path, fingerprinted in manifest.items())
+
+    @app.url_defaults
+    def fingerprint_static(endpoint, values):
+        if endpoint == "static" and values.get("filename") in manifest:
+            values["filename"] = manifest[values["filename"]]
+
+    def static(filename):
+        """Returns static file, precompressed if possible"""
+
+        path = originals.get(filename, filename)
+        # Variants are named after the fingerprint of the content they
+        # were built from; a file changed since has no variants yet
+        fingerprinted = manifest.get(path)
+        response = None
+        for encoding, suffix in VARIANTS:
+            if (fingerprinted is not None and
+                    request.accept_encodings.quality(encoding) > 0 and
+                    os.path.isfile(os.path.join(folder,
+                                                fingerprinted + suffix))):
+                response = send_from_directory(
+                    folder, fingerprinted + suffix,
+                    mimetype=mimetypes.guess_type(path)[0])
+                response.headers["Content-Encoding"] = encoding
+                break
+        if response is None:
+            response = send_from_directory(folder, path)
+        response.vary.add("Accept-Encoding")
+        if filename in originals:
+            response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        return response
+
+    app.view_functions["static"] = static
+
+
+if __name__ == "__main__":
+    # Build precompressed variants of the app's static files
+    folder = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "static")
+    print("Wrote %d precompressed files" % precompress(folder))